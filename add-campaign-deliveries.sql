@@ -0,0 +1,23 @@
+-- Append-only per-recipient delivery log used to resume interrupted campaigns
+-- email_hash is the 64-bit blake2b digest of the lowercased address, as 16 hex characters
+CREATE TABLE IF NOT EXISTS campaign_deliveries (
+  id BIGSERIAL PRIMARY KEY,
+  tracker_id TEXT NOT NULL,
+  contact_index INTEGER NOT NULL,
+  email_hash TEXT NOT NULL,
+  outcome TEXT NOT NULL CHECK (outcome IN ('sent', 'failed')),
+  smtp_response TEXT,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_campaign_deliveries_tracker_outcome
+  ON campaign_deliveries (tracker_id, outcome);
+
+-- Only the backend (service role, which bypasses RLS) reads or writes the log; no policies means no other access
+ALTER TABLE campaign_deliveries ENABLE ROW LEVEL SECURITY;
+
+-- Verify the table structure
+SELECT column_name, data_type, is_nullable, column_default 
+FROM information_schema.columns 
+WHERE table_name = 'campaign_deliveries' 
+ORDER BY ordinal_position;
@@ -0,0 +1,13 @@
+-- Persist in-process campaign progress (CampaignTracker) to email_campaigns
+-- tracker_id is the campaign id returned by /api/send-emails (temp_<timestamp>_<user_id>)
+ALTER TABLE email_campaigns
+ADD COLUMN IF NOT EXISTS tracker_id TEXT UNIQUE;
+
+CREATE INDEX IF NOT EXISTS idx_email_campaigns_user_created
+  ON email_campaigns (user_id, created_at DESC);
+
+-- Verify the table structure
+SELECT column_name, data_type, is_nullable, column_default 
+FROM information_schema.columns 
+WHERE table_name = 'email_campaigns' 
+ORDER BY ordinal_position;
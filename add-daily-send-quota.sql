@@ -0,0 +1,43 @@
+-- Messages sent per sending account per UTC day, shared by every backend instance
+-- account_key is the email_settings id (or user@host for settings without one)
+CREATE TABLE IF NOT EXISTS account_daily_usage (
+  account_key TEXT NOT NULL,
+  day DATE NOT NULL,
+  sent INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (account_key, day)
+);
+
+-- Atomically grants up to p_count more messages within p_limit for the day and returns how many were granted
+CREATE OR REPLACE FUNCTION claim_daily_quota(p_account_key TEXT, p_day DATE, p_count INTEGER, p_limit INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+  used INTEGER;
+  granted INTEGER;
+BEGIN
+  INSERT INTO account_daily_usage (account_key, day) VALUES (p_account_key, p_day)
+  ON CONFLICT (account_key, day) DO NOTHING;
+  SELECT sent INTO used FROM account_daily_usage
+  WHERE account_key = p_account_key AND day = p_day
+  FOR UPDATE;
+  granted := LEAST(p_count, GREATEST(p_limit - used, 0));
+  UPDATE account_daily_usage SET sent = used + granted
+  WHERE account_key = p_account_key AND day = p_day;
+  RETURN granted;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only the backend (service role, which bypasses RLS) may read or change usage; no policies means no other access
+ALTER TABLE account_daily_usage ENABLE ROW LEVEL SECURITY;
+
+-- The function takes any account key, so only the service role may call it
+REVOKE EXECUTE ON FUNCTION claim_daily_quota(TEXT, DATE, INTEGER, INTEGER) FROM PUBLIC, anon, authenticated;
+
+-- Old days are only needed for reporting; prune them as you see fit
+CREATE INDEX IF NOT EXISTS idx_account_daily_usage_day
+  ON account_daily_usage (day);
+
+-- Verify the table structure
+SELECT column_name, data_type, is_nullable, column_default
+FROM information_schema.columns
+WHERE table_name = 'account_daily_usage'
+ORDER BY ordinal_position;
@@ -0,0 +1,126 @@
+-- Per-user campaign totals for /api/dashboard/stats, maintained by a trigger on email_campaigns
+-- A campaign counts once it reaches a terminal status; resuming it (terminal -> running) takes it back out
+CREATE TABLE IF NOT EXISTS user_campaign_totals (
+  user_id UUID PRIMARY KEY REFERENCES auth.users(id) ON DELETE CASCADE,
+  total_campaigns INTEGER NOT NULL DEFAULT 0,
+  total_emails_sent BIGINT NOT NULL DEFAULT 0,
+  total_emails_failed BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Only the backend (service role, which bypasses RLS) and the trigger below, which runs as the table owner,
+-- touch the totals; no policies means no other access
+ALTER TABLE user_campaign_totals ENABLE ROW LEVEL SECURITY;
+
+-- One stats row per finished campaign
+CREATE UNIQUE INDEX IF NOT EXISTS idx_campaign_stats_campaign
+  ON campaign_stats (campaign_id);
+
+CREATE INDEX IF NOT EXISTS idx_email_templates_user
+  ON email_templates (user_id);
+
+CREATE OR REPLACE FUNCTION apply_campaign_totals() RETURNS TRIGGER AS $$
+DECLARE
+  old_done BOOLEAN := TG_OP <> 'INSERT'
+    AND COALESCE(OLD.status IN ('completed', 'completed_with_errors', 'failed'), FALSE);
+  new_done BOOLEAN := TG_OP <> 'DELETE'
+    AND COALESCE(NEW.status IN ('completed', 'completed_with_errors', 'failed'), FALSE);
+  row_user UUID := CASE WHEN TG_OP = 'DELETE' THEN OLD.user_id ELSE NEW.user_id END;
+  d_campaigns INTEGER := 0;
+  d_sent BIGINT := 0;
+  d_failed BIGINT := 0;
+BEGIN
+  -- Progress updates of running campaigns are the common case and change nothing here
+  IF NOT old_done AND NOT new_done THEN
+    RETURN NULL;
+  END IF;
+  IF old_done THEN
+    d_campaigns := d_campaigns - 1;
+    d_sent := d_sent - COALESCE(OLD.sent_count, 0);
+    d_failed := d_failed - COALESCE(OLD.failed_count, 0);
+  END IF;
+  IF new_done THEN
+    d_campaigns := d_campaigns + 1;
+    d_sent := d_sent + COALESCE(NEW.sent_count, 0);
+    d_failed := d_failed + COALESCE(NEW.failed_count, 0);
+  END IF;
+
+  IF row_user IS NOT NULL AND (d_campaigns <> 0 OR d_sent <> 0 OR d_failed <> 0) THEN
+    INSERT INTO user_campaign_totals (user_id, total_campaigns, total_emails_sent, total_emails_failed)
+    VALUES (row_user, d_campaigns, d_sent, d_failed)
+    ON CONFLICT (user_id) DO UPDATE SET
+      total_campaigns = user_campaign_totals.total_campaigns + EXCLUDED.total_campaigns,
+      total_emails_sent = user_campaign_totals.total_emails_sent + EXCLUDED.total_emails_sent,
+      total_emails_failed = user_campaign_totals.total_emails_failed + EXCLUDED.total_emails_failed,
+      updated_at = NOW();
+  END IF;
+
+  IF new_done THEN
+    INSERT INTO campaign_stats (campaign_id, total_recipients, successful_sends, failed_sends)
+    VALUES (NEW.id, COALESCE(NEW.total_recipients, 0), COALESCE(NEW.sent_count, 0), COALESCE(NEW.failed_count, 0))
+    ON CONFLICT (campaign_id) DO UPDATE SET
+      total_recipients = EXCLUDED.total_recipients,
+      successful_sends = EXCLUDED.successful_sends,
+      failed_sends = EXCLUDED.failed_sends;
+  ELSIF TG_OP = 'UPDATE' THEN
+    DELETE FROM campaign_stats WHERE campaign_id = OLD.id;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+DROP TRIGGER IF EXISTS email_campaigns_totals ON email_campaigns;
+CREATE TRIGGER email_campaigns_totals
+  AFTER INSERT OR DELETE OR UPDATE OF status, sent_count, failed_count ON email_campaigns
+  FOR EACH ROW EXECUTE FUNCTION apply_campaign_totals();
+
+-- Backfill from campaigns that finished before the trigger existed
+INSERT INTO user_campaign_totals (user_id, total_campaigns, total_emails_sent, total_emails_failed)
+SELECT user_id, COUNT(*), COALESCE(SUM(sent_count), 0), COALESCE(SUM(failed_count), 0)
+FROM email_campaigns
+WHERE user_id IS NOT NULL AND status IN ('completed', 'completed_with_errors', 'failed')
+GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE SET
+  total_campaigns = EXCLUDED.total_campaigns,
+  total_emails_sent = EXCLUDED.total_emails_sent,
+  total_emails_failed = EXCLUDED.total_emails_failed,
+  updated_at = NOW();
+
+INSERT INTO campaign_stats (campaign_id, total_recipients, successful_sends, failed_sends)
+SELECT id, COALESCE(total_recipients, 0), COALESCE(sent_count, 0), COALESCE(failed_count, 0)
+FROM email_campaigns
+WHERE status IN ('completed', 'completed_with_errors', 'failed')
+ON CONFLICT (campaign_id) DO NOTHING;
+
+-- Everything the dashboard shows, in one round trip; called by the backend with the service role key
+CREATE OR REPLACE FUNCTION get_dashboard_stats(p_user_id UUID, p_recent_limit INTEGER DEFAULT 10)
+RETURNS JSON AS $$
+  SELECT json_build_object(
+    'total_campaigns', COALESCE(t.total_campaigns, 0),
+    'total_emails_sent', COALESCE(t.total_emails_sent, 0),
+    'total_emails_failed', COALESCE(t.total_emails_failed, 0),
+    'templates_count', (SELECT COUNT(*) FROM email_templates WHERE user_id = p_user_id),
+    'has_email_settings', EXISTS (
+      SELECT 1 FROM email_settings WHERE user_id = p_user_id AND is_active
+    ),
+    'recent_campaigns', COALESCE((
+      SELECT json_agg(c)
+      FROM (
+        SELECT id, tracker_id, name, subject, status, progress, sent_count, failed_count,
+               total_recipients AS total_emails, created_at
+        FROM email_campaigns
+        WHERE user_id = p_user_id
+        ORDER BY created_at DESC
+        LIMIT p_recent_limit
+      ) c
+    ), '[]'::json)
+  )
+  FROM (SELECT 1) AS one
+  LEFT JOIN user_campaign_totals t ON t.user_id = p_user_id;
+$$ LANGUAGE sql STABLE;
+
+-- The function takes any user id, so only the service role may call it
+REVOKE EXECUTE ON FUNCTION get_dashboard_stats(UUID, INTEGER) FROM PUBLIC, anon, authenticated;
+
+-- Verify
+SELECT * FROM user_campaign_totals LIMIT 10;
@@ -0,0 +1,24 @@
+-- Per-user suppression list: recipients left out of future campaigns after a bounce, complaint or unsubscribe
+-- email_hash is the 64-bit blake2b digest of the lowercased address, as in campaign_deliveries
+CREATE TABLE IF NOT EXISTS email_suppressions (
+  id BIGSERIAL PRIMARY KEY,
+  user_id UUID NOT NULL REFERENCES auth.users(id) ON DELETE CASCADE,
+  email TEXT NOT NULL,
+  email_hash TEXT NOT NULL,
+  reason TEXT NOT NULL CHECK (reason IN ('bounce', 'complaint', 'unsubscribe', 'manual')),
+  tracker_id TEXT,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+  UNIQUE (user_id, email_hash)
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_suppressions_user_created
+  ON email_suppressions (user_id, created_at DESC);
+
+-- Only the backend (service role, which bypasses RLS) reads or changes the list; no policies means no other access
+ALTER TABLE email_suppressions ENABLE ROW LEVEL SECURITY;
+
+-- Verify the table structure
+SELECT column_name, data_type, is_nullable, column_default
+FROM information_schema.columns
+WHERE table_name = 'email_suppressions'
+ORDER BY ordinal_position;
@@ -0,0 +1,17 @@
+-- Several sending accounts per user: every active email_settings row takes part in a campaign
+-- weight sets each account's share of a campaign (0 pauses the account); the oldest row is the primary account
+ALTER TABLE email_settings ADD COLUMN IF NOT EXISTS weight NUMERIC NOT NULL DEFAULT 1 CHECK (weight >= 0);
+ALTER TABLE email_settings ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW();
+
+-- Older setups allowed one row per user; drop that constraint if it exists
+ALTER TABLE email_settings DROP CONSTRAINT IF EXISTS email_settings_user_id_key;
+
+CREATE INDEX IF NOT EXISTS idx_email_settings_user_active
+  ON email_settings (user_id, created_at)
+  WHERE is_active;
+
+-- Verify the table structure
+SELECT column_name, data_type, is_nullable, column_default
+FROM information_schema.columns
+WHERE table_name = 'email_settings'
+ORDER BY ordinal_position;
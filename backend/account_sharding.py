@@ -0,0 +1,279 @@
+"""
+Account Sharding - Splits one campaign across several sending accounts by weight and remaining daily quota
+"""
+
+import os
+import queue
+import threading
+import logging
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from send_scheduler import AccountScheduler, DailyQuotaExceeded
+from smtp_pool import SMTPConnectionPool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ACCOUNT_WEIGHT = 1.0
+# Upper bound on engine sub-campaigns per account in async mode (see async_shares)
+MAX_ASYNC_SHARES = int(os.getenv("MAX_ASYNC_SHARES_PER_ACCOUNT", "8"))
+PUT_TIMEOUT = 0.1
+
+_STOP = object()
+
+
+def account_weight(user_settings: dict) -> float:
+    """Relative share of a campaign for this account, from the email_settings weight column; 0 pauses it"""
+    weight = user_settings.get("weight")
+    if weight is None:
+        return DEFAULT_ACCOUNT_WEIGHT
+    try:
+        return max(0.0, float(weight))
+    except (TypeError, ValueError):
+        return DEFAULT_ACCOUNT_WEIGHT
+
+
+def async_shares(accounts: List[dict]) -> List[int]:
+    """Engine sub-campaigns per account; the async engine rotates a user's campaigns evenly, so an
+    account with twice the weight gets twice the entries"""
+    weights = [account_weight(settings) for settings in accounts]
+    if not any(weights):
+        # Every account paused with weight 0: share evenly rather than never sending
+        weights = [DEFAULT_ACCOUNT_WEIGHT] * len(weights)
+    smallest = min((weight for weight in weights if weight > 0), default=DEFAULT_ACCOUNT_WEIGHT)
+    return [max(1, min(MAX_ASYNC_SHARES, round(weight / smallest))) if weight > 0 else 0 for weight in weights]
+
+
+class AccountSelector:
+    """Smooth weighted round robin over accounts that skips those whose daily budget is used up
+
+    Budgets start at each scheduler's remaining_today() (None means unlimited). They are an
+    estimate, since other campaigns may draw on the same account; the scheduler still enforces
+    the real limit when sending. Once every account is out of budget, all of them are offered
+    again, in case the estimate was low; the scheduler stops each account at its real limit.
+    """
+
+    def __init__(self, weights: List[float], budgets: List[Optional[int]]):
+        self.weights = weights
+        self.budgets = budgets
+        self.current = [0.0] * len(weights)
+        self._round_total = 0.0
+        self._lock = threading.Lock()
+
+    def has_budget(self, account: int) -> bool:
+        budget = self.budgets[account]
+        return budget is None or budget > 0
+
+    def candidates(self, alive: List[bool]) -> List[int]:
+        """Accounts in order of preference for the next contact"""
+        with self._lock:
+            eligible = [n for n in range(len(self.weights))
+                        if alive[n] and self.weights[n] > 0 and self.has_budget(n)]
+            if not eligible:
+                eligible = [n for n in range(len(self.weights)) if alive[n]]
+            self._round_total = 0.0
+            for n in eligible:
+                weight = self.weights[n] or DEFAULT_ACCOUNT_WEIGHT
+                self.current[n] += weight
+                self._round_total += weight
+            return sorted(eligible, key=lambda n: self.current[n], reverse=True)
+
+    def assign(self, account: int) -> None:
+        with self._lock:
+            self.current[account] -= self._round_total
+            if self.budgets[account]:
+                self.budgets[account] -= 1
+
+
+class SharedContactSource:
+    """Hands contacts from one source to several accounts' engine sub-campaigns, within each account's budget"""
+
+    def __init__(self, work: Iterable[Tuple[int, dict]], selector: AccountSelector):
+        self.work = iter(work)
+        self.selector = selector
+        self._lock = threading.Lock()
+
+    def take(self, account: int) -> Optional[Tuple[int, dict]]:
+        with self._lock:
+            # An account out of budget stops drawing while any other account can still send
+            if not self.selector.has_budget(account) and any(
+                    self.selector.has_budget(n) for n in range(len(self.selector.budgets))):
+                return None
+            item = next(self.work, None)
+            if item is not None:
+                self.selector.assign(account)
+            return item
+
+    def iterator(self, account: int) -> Iterator[Tuple[int, dict]]:
+        return iter(lambda: self.take(account), None)
+
+
+class FinishAggregator:
+    """Calls on_finish once, with combined counts, after every sub-campaign of a sharded campaign finished"""
+
+    def __init__(self, parts: int, on_finish: Callable[[int, int, Optional[Exception]], None]):
+        self.remaining = parts
+        self.on_finish = on_finish
+        self.sent = 0
+        self.failed = 0
+        self.errors: List[Exception] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, sent: int, failed: int, error: Optional[Exception] = None) -> None:
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+            if error is not None:
+                self.errors.append(error)
+            self.remaining -= 1
+            if self.remaining:
+                return
+        # Only report the campaign as failed if no account could send at all, or if an account ran out of
+        # daily quota with contacts it had drawn but not sent, which a resume has to pick up
+        error = next((e for e in self.errors if isinstance(e, DailyQuotaExceeded)), None)
+        if error is None and self.errors and not self.sent and not self.failed:
+            error = self.errors[0]
+        if self.errors and error is None:
+            logger.warning(f"{len(self.errors)} sending account(s) failed; others completed the campaign")
+        self.on_finish(self.sent, self.failed, error)
+
+
+class _Shard:
+    def __init__(self, account: int, user_settings: dict, pool: SMTPConnectionPool):
+        self.account = account
+        self.user_settings = user_settings
+        self.pool = pool
+        self.queue: "queue.Queue" = queue.Queue(maxsize=pool.size * 2)
+        self.sent = 0
+        self.failed = 0
+        self.error: Optional[Exception] = None
+        self.thread: Optional[threading.Thread] = None
+
+
+class ShardedPoolSender:
+    """Threaded counterpart of SMTPConnectionPool.send_all for several accounts
+
+    The calling thread deals contacts to per-account bounded queues in weighted round-robin
+    order. Each account's own connection pool, with its own rate limits, drains its queue. When
+    the preferred account's queue stays full for PUT_TIMEOUT, another account with room takes
+    the contact, so one slow mailbox does not hold back the others. Contacts queued to an account that could not
+    connect are sent again through the remaining accounts.
+    """
+
+    def __init__(self, accounts: List[dict], schedulers: List[AccountScheduler], name: str = "sharded"):
+        self.accounts = accounts
+        self.schedulers = schedulers
+        self.name = name
+
+    def send_all(self, work: Iterable[Tuple[int, dict]],
+                 send_fn_for: Callable[[dict], Callable[[dict, object], bool]],
+                 on_result: Callable[[int, dict, bool, Optional[str]], None] = None) -> Tuple[int, int]:
+        live = list(range(len(self.accounts)))
+        selector = AccountSelector([account_weight(self.accounts[n]) for n in live],
+                                   [scheduler.remaining_today() for scheduler in self.schedulers])
+        sent = failed = 0
+        errors: List[Exception] = []
+        while True:
+            round_sent, round_failed, orphans, dead = self._round(live, selector, work, send_fn_for, on_result)
+            sent += round_sent
+            failed += round_failed
+            errors.extend(dead.values())
+            live = [n for n in live if n not in dead]
+            if not orphans:
+                break
+            if not live:
+                raise next((e for e in errors if isinstance(e, DailyQuotaExceeded)), errors[0])
+            logger.warning(f"Re-sending {len(orphans)} contacts through {len(live)} remaining account(s)")
+            work = orphans
+        if not sent and not failed and errors:
+            raise errors[0]
+        return sent, failed
+
+    def _round(self, accounts: List[int], selector: AccountSelector, work, send_fn_for, on_result):
+        shards = {}
+        for n in accounts:
+            settings = self.accounts[n]
+            # Every thread of the campaign is named "<name>-worker...", the prefix its profiler samples
+            pool = SMTPConnectionPool(settings, scheduler=self.schedulers[n], name=f"{self.name}-worker-{n}")
+            shard = _Shard(n, settings, pool)
+            shard.thread = threading.Thread(target=self._run_shard, args=(shard, send_fn_for(settings), on_result),
+                                            name=f"{self.name}-worker-{n}", daemon=True)
+            shard.thread.start()
+            shards[n] = shard
+
+        alive = [n in shards for n in range(len(self.accounts))]
+        for item in work:
+            self._deal(item, shards, selector, alive)
+
+        for shard in shards.values():
+            while shard.error is None and shard.thread.is_alive():
+                try:
+                    shard.queue.put(_STOP, timeout=PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+        for shard in shards.values():
+            shard.thread.join()
+
+        # Whatever is left in a failed account's queue was never attempted
+        orphans, dead = [], {}
+        for shard in shards.values():
+            if shard.error is None:
+                continue
+            dead[shard.account] = shard.error
+            orphans.extend(shard.pool.unsent)
+            while True:
+                try:
+                    item = shard.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    orphans.append(item)
+        return (sum(shard.sent for shard in shards.values()), sum(shard.failed for shard in shards.values()),
+                orphans, dead)
+
+    def _deal(self, item, shards, selector: AccountSelector, alive: List[bool]) -> None:
+        order = None
+        while True:
+            for n in range(len(alive)):
+                if alive[n] and shards[n].error is not None:
+                    alive[n] = False
+                    order = None
+            if order is None:
+                order = selector.candidates(alive)
+            if not order:
+                # Every account failed to connect
+                raise next(shard.error for shard in shards.values() if shard.error is not None)
+            try:
+                shards[order[0]].queue.put(item, timeout=PUT_TIMEOUT)
+                selector.assign(order[0])
+                return
+            except queue.Full:
+                pass
+            # The preferred account is falling behind; let one with room in its queue take the contact
+            for n in order[1:]:
+                if shards[n].error is not None:
+                    continue
+                try:
+                    shards[n].queue.put_nowait(item)
+                except queue.Full:
+                    continue
+                selector.assign(n)
+                return
+
+    def _run_shard(self, shard: _Shard, send_fn, on_result) -> None:
+        def contacts():
+            while True:
+                item = shard.queue.get()
+                if item is _STOP:
+                    return
+                yield item
+
+        try:
+            shard.sent, shard.failed = shard.pool.send_all(contacts(), send_fn, on_result)
+        except DailyQuotaExceeded as e:
+            # The pool logged it; keep what this account sent before its budget ran out
+            shard.sent, shard.failed = shard.pool.sent_count, shard.pool.failed_count
+            shard.error = e
+        except Exception as e:
+            logger.error(f"Sending account {shard.user_settings.get('email_user')} failed: {e}")
+            shard.error = e
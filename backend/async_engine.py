@@ -0,0 +1,374 @@
+"""
+Async SMTP Engine - One event loop sending all campaigns over a bounded set of SMTP sessions
+"""
+
+import asyncio
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Iterator, List, Optional, Tuple
+
+from metrics import smtp_active_connections, smtp_send_seconds
+from send_scheduler import (AccountScheduler, DailyQuotaExceeded, MAX_TRANSIENT_RETRIES, backoff_delay,
+                            smtp_reply)
+
+logger = logging.getLogger(__name__)
+
+ASYNC_SMTP_MAX_SESSIONS = int(os.getenv("ASYNC_SMTP_MAX_SESSIONS", "32"))
+ASYNC_SMTP_MAX_MESSAGES_PER_SESSION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+ASYNC_SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+RECONNECT_ATTEMPTS = 2
+# Contacts pulled from a campaign's source per read; reads run in the default executor, off the event loop
+CONTACT_READ_AHEAD = int(os.getenv("ASYNC_CONTACT_READ_AHEAD", "32"))
+
+
+class AsyncCampaign:
+    """A campaign queued on the engine; callbacks run on the engine's event loop thread"""
+
+    def __init__(self, campaign_id: str, user_id: str, user_settings: dict,
+                 contacts: Iterator[Tuple[int, dict]],
+                 build_message: Callable[[dict], bytes],
+                 on_result: Callable[[int, dict, bool, Optional[str]], None],
+                 on_finish: Callable[[int, int, Optional[Exception]], None],
+                 scheduler: AccountScheduler = None):
+        self.campaign_id = campaign_id
+        self.user_id = user_id
+        self.user_settings = user_settings
+        self.account_key = (user_settings['email_host'], user_settings['email_port'], user_settings['email_user'])
+        self.contacts = iter(contacts)
+        self.build_message = build_message
+        self.on_result = on_result
+        self.on_finish = on_finish
+        self.scheduler = scheduler
+        self.sent_count = 0
+        self.failed_count = 0
+        self.in_flight = 0
+        self.exhausted = False
+        self.error: Optional[Exception] = None
+        self.finished = False
+        self.connected = False
+        self.buffer: Deque[Tuple[int, dict]] = deque()
+        self.reading = False
+
+    def read_ahead(self) -> Tuple[List[Tuple[int, dict]], bool, Optional[Exception]]:
+        """Pull the next few contacts; runs on an executor thread since sources may read from the network"""
+        items = []
+        try:
+            for _ in range(CONTACT_READ_AHEAD):
+                items.append(next(self.contacts))
+        except StopIteration:
+            return items, True, None
+        except Exception as e:
+            return items, True, e
+        return items, False, None
+
+    def stop(self, error: Exception) -> None:
+        """Schedule nothing more for this campaign; contacts not yet taken are left unsent"""
+        self.error = error
+        self.exhausted = True
+        self.buffer.clear()
+
+
+class _Session:
+    """One SMTP session owned by a worker, reused while consecutive jobs share an account"""
+
+    def __init__(self):
+        self.account_key = None
+        self.smtp = None
+        self.messages_sent = 0
+
+    async def get(self, campaign: AsyncCampaign, max_messages: int):
+        if self.smtp is not None and (self.account_key != campaign.account_key or self.messages_sent >= max_messages):
+            await self.close()
+        if self.smtp is None:
+            import aiosmtplib
+            settings = campaign.user_settings
+            smtp = aiosmtplib.SMTP(hostname=settings['email_host'], port=settings['email_port'],
+                                   start_tls=settings.get("smtp_use_tls", True), timeout=ASYNC_SMTP_TIMEOUT)
+            await smtp.connect()
+            try:
+                if settings.get('email_password'):
+                    await smtp.login(settings['email_user'], settings['email_password'])
+            except Exception:
+                smtp.close()
+                raise
+            self.smtp = smtp
+            self.account_key = campaign.account_key
+            campaign.connected = True
+            self.messages_sent = 0
+            smtp_active_connections.inc()
+        return self.smtp
+
+    async def close(self) -> None:
+        if self.smtp is None:
+            return
+        try:
+            await self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+        self.smtp = None
+        self.account_key = None
+        smtp_active_connections.dec()
+
+
+def _response_code(error: Exception) -> Optional[int]:
+    recipients = getattr(error, "recipients", None)
+    if recipients:
+        codes = [getattr(recipient, "code", None) for recipient in recipients]
+        return codes[0] if all(code and 400 <= code < 500 for code in codes) else None
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+class AsyncSMTPEngine:
+    """Schedules campaigns round-robin by user, then by campaign, over max_sessions concurrent sessions"""
+
+    def __init__(self, max_sessions: int = ASYNC_SMTP_MAX_SESSIONS,
+                 max_messages_per_session: int = ASYNC_SMTP_MAX_MESSAGES_PER_SESSION):
+        self.max_sessions = max_sessions
+        self.max_messages_per_session = max_messages_per_session
+        self._users: "OrderedDict[str, Deque[AsyncCampaign]]" = OrderedDict()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._work_available: Optional[asyncio.Event] = None
+        self._start_lock = threading.Lock()
+        self._retry_in: Optional[float] = None
+
+    @property
+    def active_campaigns(self) -> int:
+        return sum(len(campaigns) for campaigns in self._users.values())
+
+    def submit(self, campaign: AsyncCampaign) -> None:
+        """Queue a campaign; safe to call from any thread"""
+        self._ensure_started()
+        self._loop.call_soon_threadsafe(self._add, campaign)
+
+    def _ensure_started(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,), name="async-smtp-engine", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run(self, ready: threading.Event) -> None:
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._work_available = asyncio.Event()
+        for n in range(self.max_sessions):
+            self._loop.create_task(self._worker(n))
+        ready.set()
+        self._loop.run_forever()
+
+    def _add(self, campaign: AsyncCampaign) -> None:
+        self._users.setdefault(campaign.user_id, deque()).append(campaign)
+        self._work_available.set()
+
+    def _next_job(self, session: "_Session",
+                  last: Optional[AsyncCampaign]) -> Optional[Tuple[AsyncCampaign, int, dict]]:
+        """Pick the next contact to send, or None after noting in self._retry_in when a rate slot frees up"""
+        self._retry_in = None
+        # Stay on the worker's last campaign while its session is open and not due for recycling:
+        # switching accounts costs a connect, STARTTLS and AUTH, and the session limit still bounds
+        # how long one campaign keeps a worker
+        if (last is not None and not last.finished and session.smtp is not None
+                and session.account_key == last.account_key
+                and session.messages_sent < self.max_messages_per_session):
+            item = self._take(last)
+            if item is not None:
+                return last, item[0], item[1]
+        # Otherwise rotate users first, then that user's campaigns, so one big sender cannot starve the rest
+        for _ in range(len(self._users)):
+            if not self._users:
+                break
+            user_id, campaigns = next(iter(self._users.items()))
+            self._users.move_to_end(user_id)
+            for _ in range(len(campaigns)):
+                if not campaigns:
+                    break
+                campaign = campaigns[0]
+                campaigns.rotate(-1)
+                item = self._take(campaign)
+                if item is not None:
+                    return campaign, item[0], item[1]
+        self._work_available.clear()
+        return None
+
+    def _take(self, campaign: AsyncCampaign) -> Optional[Tuple[int, dict]]:
+        if not campaign.buffer:
+            self._read_more(campaign)
+            self._maybe_finish(campaign)
+            return None
+        if campaign.scheduler:
+            # Skip an account that is over its send rate instead of holding a worker while it waits
+            wait = campaign.scheduler.try_reserve()
+            if wait > 0:
+                self._retry_in = wait if self._retry_in is None else min(self._retry_in, wait)
+                return None
+        item = campaign.buffer.popleft()
+        if not campaign.buffer:
+            self._read_more(campaign)
+        return item
+
+    def _read_more(self, campaign: AsyncCampaign) -> None:
+        if campaign.exhausted or campaign.reading:
+            return
+        campaign.reading = True
+        future = self._loop.run_in_executor(None, campaign.read_ahead)
+        future.add_done_callback(lambda done: self._read_done(campaign, done))
+
+    def _read_done(self, campaign: AsyncCampaign, done: "asyncio.Future") -> None:
+        campaign.reading = False
+        items, finished, error = done.result()
+        if campaign.exhausted:
+            # Stopped while the read was running
+            self._maybe_finish(campaign)
+            return
+        campaign.buffer.extend(items)
+        if error is not None:
+            logger.error(f"Campaign {campaign.campaign_id} contact source failed: {error}")
+            campaign.error = error
+        if finished:
+            campaign.exhausted = True
+        self._work_available.set()
+        self._maybe_finish(campaign)
+
+    def _drop(self, campaign: AsyncCampaign) -> None:
+        campaigns = self._users.get(campaign.user_id)
+        if campaigns is None:
+            return
+        try:
+            campaigns.remove(campaign)
+        except ValueError:
+            pass
+        if not campaigns:
+            del self._users[campaign.user_id]
+
+    def _maybe_finish(self, campaign: AsyncCampaign) -> None:
+        if (campaign.finished or not campaign.exhausted or campaign.in_flight or campaign.reading
+                or campaign.buffer):
+            return
+        campaign.finished = True
+        self._drop(campaign)
+        # on_finish may touch the network (final flushes), so keep it off the loop
+        self._loop.run_in_executor(None, campaign.on_finish, campaign.sent_count, campaign.failed_count,
+                                   campaign.error)
+
+    async def _worker(self, n: int) -> None:
+        session = _Session()
+        last: Optional[AsyncCampaign] = None
+        while True:
+            job = self._next_job(session, last)
+            if job is None:
+                if self._retry_in is None:
+                    await session.close()
+                    await self._work_available.wait()
+                else:
+                    # Only rate-limited work is left: keep the session and look again when a slot frees up
+                    try:
+                        await asyncio.wait_for(self._work_available.wait(), self._retry_in)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            campaign, index, contact = job
+            last = campaign
+            campaign.in_flight += 1
+            try:
+                success, response = await self._deliver(session, campaign, contact)
+            except DailyQuotaExceeded as e:
+                # Stop drawing contacts and leave this one and the rest unsent so a resume can pick them up
+                campaign.in_flight -= 1
+                if not isinstance(campaign.error, DailyQuotaExceeded):
+                    logger.warning(f"Campaign {campaign.campaign_id} stopped drawing contacts: {e}; "
+                                   f"the rest are left for a resume")
+                campaign.stop(e)
+                self._maybe_finish(campaign)
+                continue
+            except Exception as e:
+                success, response = False, str(e)
+            campaign.in_flight -= 1
+            if success:
+                campaign.sent_count += 1
+            else:
+                campaign.failed_count += 1
+            try:
+                campaign.on_result(index, contact, success, response)
+            except Exception as e:
+                logger.error(f"Result callback failed for {contact.get('email')}: {e}")
+            self._maybe_finish(campaign)
+
+    async def _deliver(self, session: _Session, campaign: AsyncCampaign, contact: dict) -> Tuple[bool, Optional[str]]:
+        import aiosmtplib
+        if campaign.scheduler:
+            # Raises DailyQuotaExceeded for the worker to stop the campaign on
+            if campaign.scheduler.needs_lease():
+                # Claiming more of the shared daily budget is a Supabase call; keep it off the loop
+                await asyncio.get_running_loop().run_in_executor(None, campaign.scheduler.consume_daily)
+            else:
+                campaign.scheduler.consume_daily()
+        try:
+            message = campaign.build_message(contact)
+        except Exception as e:
+            logger.error(f"Failed to build email to {contact.get('email')}: {e}")
+            return False, str(e)
+
+        reconnects = 0
+        transient_attempts = 0
+        while True:
+            if campaign.scheduler and (reconnects or transient_attempts):
+                # The first attempt's slot was taken when the job was picked; retries take another
+                delay = campaign.scheduler.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                smtp = await session.get(campaign, self.max_messages_per_session)
+                session.messages_sent += 1
+                started = time.perf_counter()
+                await smtp.sendmail(campaign.user_settings['email_user'], [contact["email"]], message)
+                smtp_send_seconds.observe(time.perf_counter() - started)
+                return True, "250 OK"
+            except aiosmtplib.SMTPAuthenticationError as e:
+                # Every later message would fail the same way; stop scheduling this campaign
+                logger.error(f"Campaign {campaign.campaign_id} SMTP login failed: {e}")
+                campaign.stop(e)
+                await session.close()
+                return False, str(e)
+            except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, ConnectionError,
+                    asyncio.TimeoutError) as e:
+                reconnects += 1
+                logger.warning(f"SMTP connection lost while sending to {contact.get('email')} "
+                               f"(attempt {reconnects}): {e}")
+                await session.close()
+                if reconnects > RECONNECT_ATTEMPTS:
+                    if not campaign.connected:
+                        # The server was never reachable, as when the threaded pool fails to connect
+                        logger.error(f"Campaign {campaign.campaign_id} could not connect to SMTP: {e}")
+                        campaign.stop(e)
+                    return False, str(e)
+            except aiosmtplib.SMTPException as e:
+                code = _response_code(e)
+                if code is None or not 400 <= code < 500:
+                    logger.error(f"Failed to send email to {contact.get('email')}: {e}")
+                    return False, smtp_reply(e)
+                transient_attempts += 1
+                if transient_attempts > MAX_TRANSIENT_RETRIES:
+                    return False, smtp_reply(e)
+                if code == 421:
+                    await session.close()
+                await asyncio.sleep(backoff_delay(transient_attempts))
+
+
+_engine: Optional[AsyncSMTPEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_async_engine() -> AsyncSMTPEngine:
+    """Process-wide engine, started on first use"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncSMTPEngine()
+        return _engine
@@ -0,0 +1,414 @@
+"""
+Batch Delivery - Sends one non-personalized message to many recipients per SMTP transaction, grouped by domain
+"""
+
+import os
+import re
+import queue
+import smtplib
+import ssl
+import threading
+import time
+import logging
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import send_queue_depth, smtp_active_connections, smtp_batch_seconds
+from send_scheduler import (AccountScheduler, DailyQuotaExceeded, MAX_TRANSIENT_RETRIES, backoff_delay,
+                            smtp_reply, transient_smtp_code)
+from smtp_pool import (CONNECTION_ERRORS, DEFAULT_MAX_MESSAGES_PER_CONNECTION, DEFAULT_POOL_SIZE,
+                       DEFAULT_RECONNECT_ATTEMPTS, DEFAULT_SMTP_TIMEOUT, PooledSMTPConnection, claim_warm_connection)
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# "relay" sends through the account's own SMTP server, "mx" straight to each recipient domain's mail exchanger
+BATCH_DELIVERY_MODES = ("relay", "mx")
+# RFC 5321 servers must accept at least 100 recipients per transaction
+BATCH_MAX_RECIPIENTS = int(os.getenv("BATCH_MAX_RECIPIENTS", "50"))
+# Part-filled domain batches held back while waiting for more recipients of the same domain
+BATCH_BUFFER_LIMIT = int(os.getenv("BATCH_BUFFER_LIMIT", "5000"))
+DIRECT_MX_PORT = int(os.getenv("DIRECT_MX_PORT", "25"))
+# "host:port" that receives every domain's mail instead of its MX, for a local stand-in server
+DIRECT_MX_OVERRIDE = os.getenv("DIRECT_MX_OVERRIDE")
+MX_LOOKUP_TIMEOUT = float(os.getenv("MX_LOOKUP_TIMEOUT", "5"))
+# Direct MX delivery never authenticates, so nothing upstream checks the envelope sender. It stays off
+# unless the operator enables it and lists the sender domains this host may send for (SPF/DKIM)
+ALLOW_DIRECT_MX = os.getenv("ALLOW_DIRECT_MX", "").lower() in ("1", "true", "yes")
+DIRECT_MX_SENDER_DOMAINS = frozenset(
+    domain.strip().lower() for domain in os.getenv("DIRECT_MX_SENDER_DOMAINS", "").split(",") if domain.strip()
+)
+
+# The message is identical for every recipient, so none of them is named in the header
+BATCH_RECIPIENT_HEADER = "undisclosed-recipients:;"
+
+mx_cache = TTLCache("mx", maxsize=int(os.getenv("MX_CACHE_SIZE", "4096")), ttl=float(os.getenv("MX_CACHE_TTL", "3600")))
+
+_LINE_ENDINGS = re.compile(rb"\r\n|\n|\r(?!\n)")
+
+_STOP = object()
+
+
+class NoMailExchanger(smtplib.SMTPResponseException):
+    """The recipient domain has no usable MX (or A) record"""
+
+    def __init__(self, domain: str):
+        super().__init__(550, f"5.1.2 No mail exchanger for {domain}".encode())
+
+
+def prepare_data(message: bytes) -> bytes:
+    """Dot-stuff a message and append the DATA terminator, once for the whole campaign"""
+    data = _LINE_ENDINGS.sub(b"\r\n", message)
+    if data.startswith(b"."):
+        data = b"." + data
+    data = data.replace(b"\r\n.", b"\r\n..")
+    if not data.endswith(b"\r\n"):
+        data += b"\r\n"
+    return data + b".\r\n"
+
+
+def recipient_domain(email: str) -> str:
+    return email.rpartition("@")[2].lower()
+
+
+def check_direct_mx_sender(sender: Optional[str]) -> None:
+    """Raise ValueError unless the operator allows direct MX delivery from this sender's domain"""
+    if not ALLOW_DIRECT_MX:
+        raise ValueError("direct MX delivery is disabled on this server")
+    domain = recipient_domain(sender or "")
+    if not domain or domain not in DIRECT_MX_SENDER_DOMAINS:
+        raise ValueError(f"sender domain {domain or '(none)'} is not allowed for direct MX delivery")
+
+
+def domain_batches(work: Iterable[Tuple[int, dict]], batch_size: int = BATCH_MAX_RECIPIENTS,
+                   buffer_limit: int = BATCH_BUFFER_LIMIT) -> Iterator[Tuple[str, List[Tuple[int, dict]]]]:
+    """Group (index, contact) pairs into per-domain batches of up to batch_size, holding at most buffer_limit back"""
+    buckets: Dict[str, List[Tuple[int, dict]]] = {}
+    buffered = 0
+    for item in work:
+        domain = recipient_domain(item[1]["email"])
+        bucket = buckets.setdefault(domain, [])
+        bucket.append(item)
+        buffered += 1
+        if len(bucket) >= batch_size:
+            del buckets[domain]
+            buffered -= len(bucket)
+            yield domain, bucket
+        elif buffered >= buffer_limit:
+            # Too many domains with only a few recipients each; send what has been collected
+            yield from buckets.items()
+            buckets = {}
+            buffered = 0
+    yield from buckets.items()
+
+
+def resolve_mx(domain: str) -> List[Tuple[str, int]]:
+    """Mail exchangers for a domain in preference order, falling back to the domain itself (RFC 5321 5.1)"""
+    if DIRECT_MX_OVERRIDE:
+        host, _, port = DIRECT_MX_OVERRIDE.rpartition(":")
+        return [(host or port, int(port) if host else DIRECT_MX_PORT)]
+    hosts = mx_cache.get(domain)
+    if hosts is not None:
+        return hosts
+    # dnspython is installed with email-validator
+    import dns.exception
+    import dns.resolver
+    try:
+        answers = dns.resolver.resolve(domain, "MX", lifetime=MX_LOOKUP_TIMEOUT)
+        # A null MX (".") says the domain accepts no mail at all (RFC 7505)
+        names = [str(answer.exchange).rstrip(".") for answer in sorted(answers, key=lambda answer: answer.preference)]
+        hosts = [(name, DIRECT_MX_PORT) for name in names if name]
+    except dns.resolver.NoAnswer:
+        hosts = [(domain, DIRECT_MX_PORT)]
+    except dns.resolver.NXDOMAIN:
+        hosts = []
+    except dns.exception.DNSException as e:
+        raise smtplib.SMTPResponseException(451, f"4.4.3 MX lookup for {domain} failed: {e}".encode())
+    mx_cache.set(domain, hosts)
+    return hosts
+
+
+def send_batch(server: smtplib.SMTP, sender: str, recipients: List[str], data: bytes) -> List[Tuple[int, bytes]]:
+    """Run one MAIL / RCPT... / DATA transaction and return the deciding (code, reply) for each recipient
+
+    With PIPELINING the envelope goes out in a single write and the replies are read back in
+    order, so the whole transaction costs two round trips (envelope, then DATA and the message)
+    plus the final reply, whatever the number of recipients. data must come from prepare_data().
+    """
+    server.ehlo_or_helo_if_needed()
+    if server.has_extn("pipelining"):
+        server.send("".join([f"MAIL FROM:<{sender}>\r\n"] + [f"RCPT TO:<{rcpt}>\r\n" for rcpt in recipients]))
+        mail_reply = server.getreply()
+        rcpt_replies = [server.getreply() for _ in recipients]
+    else:
+        mail_reply = server.mail(sender)
+        rcpt_replies = [server.rcpt(rcpt) for rcpt in recipients] if mail_reply[0] == 250 else []
+
+    if mail_reply[0] != 250:
+        server.rset()
+        return [mail_reply] * len(recipients)
+    accepted = [code in (250, 251) for code, _ in rcpt_replies]
+    if not any(accepted):
+        server.rset()
+        return rcpt_replies
+
+    data_reply = server.docmd("DATA")
+    if data_reply[0] == 354:
+        server.send(data)
+        data_reply = server.getreply()
+    else:
+        server.rset()
+    return [data_reply if ok else reply for ok, reply in zip(accepted, rcpt_replies)]
+
+
+class _DirectConnection:
+    """An unauthenticated session to a recipient domain's MX, kept while consecutive batches share the host"""
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self.server: Optional[smtplib.SMTP] = None
+        self.host: Optional[Tuple[str, int]] = None
+        self.messages_sent = 0
+
+    def get(self, domain: str) -> smtplib.SMTP:
+        hosts = resolve_mx(domain)
+        if not hosts:
+            raise NoMailExchanger(domain)
+        if self.server is not None and self.host in hosts and self.messages_sent < self.max_messages:
+            return self.server
+        self.close()
+        error: Optional[Exception] = None
+        for host in hosts:
+            try:
+                server = smtplib.SMTP(host[0], host[1], timeout=DEFAULT_SMTP_TIMEOUT)
+            except (OSError, smtplib.SMTPException) as e:
+                # Lower-preference exchangers are there for exactly this case
+                error = e
+                continue
+            try:
+                server.ehlo()
+                if server.has_extn("starttls"):
+                    # Opportunistic TLS, as between MTAs: encrypt when offered without insisting on a valid certificate
+                    context = ssl.create_default_context()
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                    server.starttls(context=context)
+            except Exception:
+                server.close()
+                raise
+            self.server, self.host, self.messages_sent = server, host, 0
+            smtp_active_connections.inc()
+            return server
+        raise error
+
+    def mark_used(self) -> None:
+        self.messages_sent += 1
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+        self.server = None
+        self.host = None
+        smtp_active_connections.dec()
+
+
+class _RelayConnection:
+    """Adapts a PooledSMTPConnection to the account's relay to the per-domain interface of _DirectConnection"""
+
+    def __init__(self, connection: PooledSMTPConnection):
+        self.connection = connection
+
+    def get(self, domain: str) -> smtplib.SMTP:
+        return self.connection.get()
+
+    def mark_used(self) -> None:
+        self.connection.mark_used()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class BatchSender:
+    """Delivers a message that is identical for every contact in multi-recipient transactions
+
+    Contacts are grouped by domain into batches of up to batch_size recipients, and worker threads
+    each owning one SMTP session send a batch per transaction. Rate limits apply per transaction;
+    the daily quota is still counted per recipient. Recipients refused with a temporary (4xx)
+    reply are retried together in a later transaction.
+    """
+
+    def __init__(self, user_settings: dict, message: bytes, mode: str = "relay", scheduler: AccountScheduler = None,
+                 size: int = None, batch_size: int = BATCH_MAX_RECIPIENTS,
+                 reconnect_attempts: int = DEFAULT_RECONNECT_ATTEMPTS, transient_retries: int = MAX_TRANSIENT_RETRIES,
+                 name: str = "batch"):
+        if mode not in BATCH_DELIVERY_MODES:
+            raise ValueError(f"Unknown batch delivery mode {mode!r}")
+        if mode == "mx":
+            check_direct_mx_sender(user_settings.get("email_user"))
+        self.user_settings = user_settings
+        self.data = prepare_data(message)
+        self.mode = mode
+        self.scheduler = scheduler
+        self.size = max(1, int(size or user_settings.get("smtp_pool_size") or DEFAULT_POOL_SIZE))
+        self.batch_size = max(1, batch_size)
+        self.max_messages = int(user_settings.get("smtp_max_messages_per_connection")
+                                or DEFAULT_MAX_MESSAGES_PER_CONNECTION)
+        self.reconnect_attempts = reconnect_attempts
+        self.transient_retries = transient_retries
+        self.name = name
+        self._lock = threading.Lock()
+        self.sent_count = 0
+        self.failed_count = 0
+        self.transactions = 0
+        self.quota_error: Optional[DailyQuotaExceeded] = None
+
+    def send_all(self, contacts: Iterable[Tuple[int, dict]],
+                 on_result: Callable[[int, dict, bool, Optional[str]], None] = None) -> Tuple[int, int]:
+        """Send to every (index, contact) pair and return the aggregate (sent, failed) counts
+
+        In relay mode the first connection is opened on the calling thread, as in
+        SMTPConnectionPool.send_all, so that authentication errors reach the caller.
+
+        Raises DailyQuotaExceeded, after the batches already drawn are sent, once the account's
+        daily budget runs out; the remaining contacts are left unsent for a resume.
+        """
+        first_connection = None
+        if self.mode == "relay":
+            first_connection = claim_warm_connection(self.user_settings, self.max_messages)
+            if first_connection is None:
+                first_connection = PooledSMTPConnection(self.user_settings, self.max_messages)
+                first_connection.connect()
+
+        work: "queue.Queue" = queue.Queue(maxsize=self.size * 2)
+        workers = []
+        for n in range(self.size):
+            if self.mode == "relay":
+                pooled = first_connection if n == 0 else PooledSMTPConnection(self.user_settings, self.max_messages)
+                connection = _RelayConnection(pooled)
+            else:
+                connection = _DirectConnection(self.max_messages)
+            worker = threading.Thread(target=self._worker, args=(connection, work, on_result),
+                                      name=f"{self.name}-worker-{n}", daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        try:
+            for domain, batch in domain_batches(self._within_quota(contacts), self.batch_size):
+                send_queue_depth.inc(len(batch))
+                work.put((domain, batch))
+        finally:
+            for _ in workers:
+                work.put(_STOP)
+            for worker in workers:
+                worker.join()
+
+        logger.info(f"{self.name}: {self.sent_count} sent, {self.failed_count} failed "
+                    f"in {self.transactions} transactions")
+        if self.quota_error is not None:
+            raise self.quota_error
+        return self.sent_count, self.failed_count
+
+    def _within_quota(self, contacts: Iterable[Tuple[int, dict]]) -> Iterator[Tuple[int, dict]]:
+        for index, contact in contacts:
+            if self.scheduler:
+                try:
+                    self.scheduler.consume_daily()
+                except DailyQuotaExceeded as e:
+                    # Stop drawing contacts so a resume can send the rest
+                    logger.warning(f"{self.name} stopped drawing contacts: {e}; the rest are left for a resume")
+                    self.quota_error = e
+                    return
+            yield index, contact
+
+    def _worker(self, connection, work: "queue.Queue", on_result) -> None:
+        try:
+            while True:
+                item = work.get()
+                if item is _STOP:
+                    break
+                domain, batch = item
+                send_queue_depth.dec(len(batch))
+                self._deliver(connection, domain, batch, on_result)
+        finally:
+            connection.close()
+
+    def _deliver(self, connection, domain: str, batch: List[Tuple[int, dict]], on_result) -> None:
+        sender = self.user_settings['email_user']
+        pending = batch
+        reconnects = 0
+        transient_attempts = 0
+        while pending:
+            if self.scheduler:
+                self.scheduler.wait_for_slot()
+            try:
+                server = connection.get(domain)
+                started = time.perf_counter()
+                replies = send_batch(server, sender, [contact["email"] for _, contact in pending], self.data)
+                smtp_batch_seconds.observe(time.perf_counter() - started)
+                connection.mark_used()
+                with self._lock:
+                    self.transactions += 1
+            except CONNECTION_ERRORS as e:
+                reconnects += 1
+                logger.warning(f"SMTP connection lost while sending a batch of {len(pending)} to {domain} "
+                               f"(attempt {reconnects}): {e}")
+                connection.close()
+                if reconnects > self.reconnect_attempts:
+                    self._record_all(pending, False, str(e), on_result)
+                    return
+                continue
+            except Exception as e:
+                connection.close()
+                if transient_smtp_code(e) and transient_attempts < self.transient_retries:
+                    # A temporary failure for the whole batch, such as a failed MX lookup or a 4xx to MAIL FROM
+                    transient_attempts += 1
+                    delay = backoff_delay(transient_attempts)
+                    logger.info(f"Temporary error sending a batch of {len(pending)} to {domain}: {e}; "
+                                f"retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    continue
+                logger.error(f"Error sending a batch of {len(pending)} to {domain}: {e}")
+                self._record_all(pending, False, smtp_reply(e), on_result)
+                return
+
+            deferred = []
+            for (index, contact), (code, message) in zip(pending, replies):
+                response = f"{code} {message.decode('utf-8', 'replace')}"
+                if 200 <= code < 300:
+                    self._record(index, contact, True, response, on_result)
+                elif 400 <= code < 500 and transient_attempts < self.transient_retries:
+                    deferred.append((index, contact))
+                else:
+                    self._record(index, contact, False, response, on_result)
+            pending = deferred
+            if pending:
+                transient_attempts += 1
+                if any(code == 421 for code, _ in replies):
+                    # The server is closing the session; start a fresh one for the retry
+                    connection.close()
+                delay = backoff_delay(transient_attempts)
+                logger.info(f"Temporary SMTP errors for {len(pending)} recipients at {domain}, "
+                            f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _record_all(self, batch: List[Tuple[int, dict]], success: bool, response: str, on_result) -> None:
+        for index, contact in batch:
+            self._record(index, contact, success, response, on_result)
+
+    def _record(self, index: int, contact: dict, success: bool, response: Optional[str], on_result) -> None:
+        with self._lock:
+            if success:
+                self.sent_count += 1
+            else:
+                self.failed_count += 1
+        if on_result:
+            try:
+                on_result(index, contact, success, response)
+            except Exception as e:
+                logger.error(f"Result callback failed for {contact.get('email')}: {e}")
@@ -0,0 +1,90 @@
+"""
+Import Time - Checks the cold-start import cost of main.py against a budget
+
+Runs `python -X importtime -c "import main"` in a fresh interpreter several times and fails when
+the median cost of importing main (excluding functions_framework, which the Cloud Functions
+runtime has already loaded) exceeds the budget. It also fails if a module that should only be
+imported on first use was imported. Example:
+
+    python benchmarks/import_time.py --budget-ms 150 --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy dependencies that main.py must only import when a request needs them
+LAZY_MODULES = ("supabase", "markdown", "email_validator", "aiosmtplib", "async_engine", "email.mime")
+PRELOADED_MODULES = ("functions_framework",)
+DEFAULT_BUDGET_MS = 150.0
+
+
+def measure() -> dict:
+    """Return {module: cumulative microseconds} for top-level imports made while importing main"""
+    env = dict(os.environ)
+    env.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+    env.setdefault("SUPABASE_SERVICE_ROLE_KEY", "importtime.importtime.importtime")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+    modules = {}
+    seen_main = False
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if name == "main":
+            seen_main = True
+        # Nested imports are recorded by package and full name, so LAZY_MODULES can list either
+        modules.setdefault(name.split(".")[0], 0)
+        modules.setdefault(name, 0)
+        if depth <= 1:
+            modules[name] = int(cumulative)
+    if not seen_main:
+        raise RuntimeError("main was not imported")
+    return modules
+
+
+def main_import_ms(modules: dict) -> float:
+    """Cost of importing main from measure() output, less what the runtime has already loaded"""
+    preloaded = sum(modules.get(name, 0) for name in PRELOADED_MODULES)
+    return (modules["main"] - preloaded) / 1000
+
+
+def eager_modules(modules: dict) -> list:
+    """The LAZY_MODULES that measure() saw imported at load time"""
+    return [name for name in LAZY_MODULES if name in modules]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check main.py import time against a budget")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    costs = []
+    for _ in range(args.runs):
+        modules = measure()
+        costs.append(main_import_ms(modules))
+        eager = eager_modules(modules)
+        if eager:
+            print(f"FAIL: imported at load time: {', '.join(eager)}")
+            sys.exit(1)
+
+    median = statistics.median(costs)
+    print(f"main import: median {median:.1f}ms over {args.runs} runs "
+          f"(min {min(costs):.1f}ms, max {max(costs):.1f}ms, budget {args.budget_ms:.0f}ms)")
+    if median > args.budget_ms:
+        print("FAIL: over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Campaign Benchmark - Runs campaigns through send_bulk_emails_task against a local SMTP sink
+
+Supabase is replaced by an in-memory stub and SMTP by benchmarks/smtp_sink.py, so no
+real mail or database traffic is generated. Each scenario runs in its own process and the sink in
+another, so that peak RSS and CPU time are measured for the sender alone. Example:
+
+    python benchmarks/run_benchmark.py --contacts 1000 5000 --attachments 0 2 \\
+        --latency-ms 5 --error-rate 0.01 --output bench_results.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from smtp_sink import SMTPSink
+
+BENCH_USER_ID = "00000000-0000-0000-0000-000000000000"
+TERMINAL_STATUSES = ("completed", "completed_with_errors", "failed")
+
+
+class _StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class _StubQuery:
+    """Accepts the PostgREST builder calls the backend makes and returns canned rows"""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.rows = None
+
+    def __getattr__(self, name):
+        # select/eq/range/limit/order and friends: chainable no-ops
+        return lambda *args, **kwargs: self
+
+    def insert(self, rows, *args, **kwargs):
+        self.rows = rows if isinstance(rows, list) else [rows]
+        return self
+
+    upsert = insert
+    update = insert
+
+    def execute(self):
+        if self.client.latency:
+            time.sleep(self.client.latency)
+        with self.client.lock:
+            self.client.calls[self.table] = self.client.calls.get(self.table, 0) + 1
+        if self.rows is not None:
+            return _StubResponse(self.rows)
+        return _StubResponse(self.client.tables.get(self.table, []))
+
+
+class StubSupabase:
+    """Minimal stand-in for the supabase Client used by the tracker and delivery log"""
+
+    def __init__(self, latency: float = 0.0, tables: dict = None):
+        self.latency = latency
+        self.tables = tables or {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def table(self, name):
+        return _StubQuery(self, name)
+
+
+def build_template(paragraphs: int, personalized: bool = True) -> dict:
+    if personalized:
+        paragraph = ("Hello **{name}**, we noticed {company} is hiring for {jobTitle}. "
+                     "Here is a [link](https://example.com) and some *emphasis* for {email}.")
+    else:
+        paragraph = ("Hello **there**, we noticed your team is hiring. "
+                     "Here is a [link](https://example.com) and some *emphasis* for you.")
+    return {
+        "name": "Benchmark",
+        "subject": "Benchmark campaign",
+        "body": "\n\n".join(["# Update"] + [paragraph] * max(1, paragraphs)),
+    }
+
+
+def build_attachments(count: int, size_kb: int) -> list:
+    import base64
+    return [
+        {"filename": f"attachment_{n}.bin",
+         "content": base64.b64encode(os.urandom(size_kb * 1024)).decode("ascii"),
+         "content_type": "application/octet-stream"}
+        for n in range(count)
+    ]
+
+
+def build_contacts(count: int, domains: int = 1) -> list:
+    return [
+        {"name": f"Contact {i}", "email": f"contact{i}@example{i % domains}.com", "company": "Example Inc",
+         "job_title": "Engineer"}
+        for i in range(count)
+    ]
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def serve_sink(latency: float, error_rate: float, ports: "multiprocessing.Queue", stop, stats: "multiprocessing.Queue") -> None:
+    """Run the SMTP sink in its own process until stop is set, then report its counters"""
+    sink = SMTPSink(latency=latency, error_rate=error_rate).start()
+    ports.put(sink.port)
+    stop.wait()
+    stats.put(sink.stats.as_dict())
+    sink.shutdown()
+
+
+def run_scenario(scenario: dict, sink_port: int, results: "multiprocessing.Queue") -> None:
+    """Run one campaign in this (fresh) process and put its measurements on the results queue"""
+    os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+    os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "bench.bench.bench")
+    os.environ["SMTP_POOL_SIZE"] = str(scenario["pool_size"])
+    os.environ["ASYNC_SMTP_MAX_SESSIONS"] = str(scenario["pool_size"])
+    # Direct-MX delivery goes to the sink for every recipient domain
+    os.environ["DIRECT_MX_OVERRIDE"] = f"127.0.0.1:{sink_port}"
+    os.environ["ALLOW_DIRECT_MX"] = "1"
+    os.environ["DIRECT_MX_SENDER_DOMAINS"] = "example.com"
+    import logging
+    logging.disable(logging.WARNING)
+
+    import main
+    import async_engine
+    import batch_delivery
+    from campaign_tracker import SupabaseCampaignStore
+    from delivery_log import SupabaseDeliveryStore
+    import send_scheduler
+    import smtp_pool
+
+    stub = StubSupabase(latency=scenario["supabase_latency_ms"] / 1000)
+    main.supabase = stub
+    main.campaign_tracker.attach_store(SupabaseCampaignStore(stub))
+    main.delivery_store = SupabaseDeliveryStore(stub)
+    main.SEND_ENGINE = scenario["engine"]
+    send_scheduler.BACKOFF_BASE_SECONDS = 0.01
+
+    latencies = []
+    latency_lock = threading.Lock()
+
+    def record(elapsed):
+        with latency_lock:
+            latencies.append(elapsed)
+
+    # Both engines are timed per contact from the moment a worker takes it off the queue until its outcome
+    # is known, just before on_result: quota and rate waits, building the message, the SMTP transaction
+    # and any retries all count. Batch delivery is timed the same way per batch
+    send_with_reconnect = smtp_pool.SMTPConnectionPool._send_with_reconnect
+
+    def timed_send_with_reconnect(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return send_with_reconnect(self, *args, **kwargs)
+        finally:
+            record(time.perf_counter() - started)
+
+    deliver = async_engine.AsyncSMTPEngine._deliver
+
+    async def timed_deliver(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await deliver(self, *args, **kwargs)
+        finally:
+            record(time.perf_counter() - started)
+
+    deliver_batch = batch_delivery.BatchSender._deliver
+
+    def timed_deliver_batch(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return deliver_batch(self, *args, **kwargs)
+        finally:
+            record(time.perf_counter() - started)
+
+    smtp_pool.SMTPConnectionPool._send_with_reconnect = timed_send_with_reconnect
+    async_engine.AsyncSMTPEngine._deliver = timed_deliver
+    batch_delivery.BatchSender._deliver = timed_deliver_batch
+
+    user_settings = {
+        "id": "bench",
+        "email_host": "127.0.0.1",
+        "email_port": sink_port,
+        "email_user": "bench@example.com",
+        "email_password": "",
+        "email_display_name": "Benchmark",
+        "smtp_use_tls": False,
+        "max_messages_per_second": 1_000_000,
+    }
+    contacts = build_contacts(scenario["contacts"], scenario["domains"])
+    template = build_template(scenario["template_paragraphs"], personalized=not scenario["static_template"])
+    attachments = build_attachments(scenario["attachments"], scenario["attachment_kb"])
+    campaign_id = f"temp_bench_{BENCH_USER_ID}"
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    main.campaign_tracker.create_temp_campaign(campaign_id, len(contacts), user_id=BENCH_USER_ID, template=template)
+    main.launch_campaign(campaign_id, contacts, template, BENCH_USER_ID, attachments, user_settings=user_settings,
+                         delivery=scenario["delivery"])
+    while True:
+        status = main.campaign_tracker.get_temp_campaign_status(campaign_id)
+        if status and status["status"] in TERMINAL_STATUSES:
+            break
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    cpu_time = time.process_time() - cpu_started
+    main.campaign_tracker.flush()
+
+    latencies.sort()
+    results.put({
+        "scenario": scenario,
+        "status": status["status"],
+        "sent": status["sent"],
+        "failed": status["failed"],
+        "elapsed_seconds": elapsed,
+        "messages_per_second": status["sent"] / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 0.50) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cpu_seconds": cpu_time,
+        "supabase_calls": stub.calls,
+    })
+
+
+def wait_for(results: "multiprocessing.Queue", process, timeout: float = 1.0):
+    """Take the next item a child process puts on results, or raise RuntimeError if it exits without one"""
+    while True:
+        try:
+            return results.get(timeout=timeout)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The item may have landed between the timeout and the liveness check
+        try:
+            return results.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError(f"{process.name} exited with code {process.exitcode} without reporting")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark campaign sending against a local SMTP sink")
+    parser.add_argument("--contacts", type=int, nargs="+", default=[1000])
+    parser.add_argument("--attachments", type=int, nargs="+", default=[0])
+    parser.add_argument("--attachment-kb", type=int, default=256)
+    parser.add_argument("--template-paragraphs", type=int, nargs="+", default=[3])
+    parser.add_argument("--engine", choices=["threaded", "async"], nargs="+", default=["threaded"])
+    parser.add_argument("--pool-size", type=int, nargs="+", default=[4])
+    parser.add_argument("--delivery", choices=["single", "relay", "mx"], nargs="+", default=["single"],
+                        help="one message per contact, or batched recipients (needs --static-template)")
+    parser.add_argument("--static-template", action="store_true", help="template without personalization")
+    parser.add_argument("--domains", type=int, default=1, help="number of recipient domains")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="sink delay per message")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of RCPTs answered with 451")
+    parser.add_argument("--supabase-latency-ms", type=float, default=0.0, help="delay per stubbed Supabase call")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for contacts, attachments, paragraphs, engine, pool_size, delivery in itertools.product(
+            args.contacts, args.attachments, args.template_paragraphs, args.engine, args.pool_size, args.delivery):
+        scenario = {
+            "contacts": contacts,
+            "attachments": attachments,
+            "attachment_kb": args.attachment_kb,
+            "template_paragraphs": paragraphs,
+            "engine": engine,
+            "pool_size": pool_size,
+            "delivery": delivery,
+            "static_template": args.static_template,
+            "domains": args.domains,
+            "latency_ms": args.latency_ms,
+            "error_rate": args.error_rate,
+            "supabase_latency_ms": args.supabase_latency_ms,
+        }
+        ports, stats, scenario_results = context.Queue(), context.Queue(), context.Queue()
+        stop = context.Event()
+        sink = context.Process(target=serve_sink, name="smtp-sink",
+                               args=(args.latency_ms / 1000, args.error_rate, ports, stop, stats))
+        sink.start()
+        process = context.Process(target=run_scenario, name="scenario",
+                                  args=(scenario, wait_for(ports, sink), scenario_results))
+        process.start()
+        try:
+            result = wait_for(scenario_results, process)
+        except RuntimeError as e:
+            # A crashed scenario must not hang the run; record it and go on with the next one
+            process.join()
+            stop.set()
+            sink.join()
+            results.append({"scenario": scenario, "status": "crashed", "error": str(e)})
+            print(f"{engine:>8} {delivery:<6} contacts={contacts:<7} attachments={attachments} "
+                  f"pool={pool_size:<3} [crashed: {e}]")
+            continue
+        process.join()
+        stop.set()
+        result["sink"] = wait_for(stats, sink)
+        sink.join()
+        results.append(result)
+        print(f"{engine:>8} {delivery:<6} contacts={contacts:<7} attachments={attachments} pool={pool_size:<3} "
+              f"{result['messages_per_second']:9.1f} msg/s  p50={result['latency_p50_ms']:.2f}ms  "
+              f"p99={result['latency_p99_ms']:.2f}ms  rss={result['peak_rss_mb']:.1f}MB  "
+              f"cpu={result['cpu_seconds']:.2f}s  smtp={result['sink']['transactions']}tx/"
+              f"{result['sink']['bytes'] / 1e6:.1f}MB  [{result['status']}]")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "generated_at": datetime.utcnow().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "results": results,
+        }, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+SMTP Sink - Local stand-in SMTP server for benchmarks, with injectable latency and temporary errors
+
+Run standalone with:
+    python benchmarks/smtp_sink.py --port 2525 --latency-ms 20 --error-rate 0.01
+"""
+
+import argparse
+import base64
+import random
+import socketserver
+import threading
+import time
+import logging
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SinkStats:
+    """Counters shared by all sink connections"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.transient_errors = 0
+        self.transactions = 0
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "connections": self.connections,
+                "messages": self.messages,
+                "recipients": self.recipients,
+                "bytes": self.bytes,
+                "transient_errors": self.transient_errors,
+                "transactions": self.transactions,
+            }
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Speaks enough ESMTP (EHLO, AUTH, PIPELINING, MAIL, RCPT, DATA) for smtplib and aiosmtplib"""
+
+    # Replies go out one line per write; with Nagle on, a pipelined envelope's replies would stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def reply(self, line: str) -> None:
+        self.wfile.write((line + "\r\n").encode("ascii"))
+
+    def handle(self) -> None:
+        server: SMTPSink = self.server
+        server.stats.add(connections=1)
+        self.reply("220 smtp-sink ESMTP ready")
+        sender: Optional[str] = None
+        recipients: List[str] = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").rstrip("\r\n")
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                if verb == "HELO":
+                    self.reply("250 smtp-sink")
+                else:
+                    for extension in ("smtp-sink", "PIPELINING", "8BITMIME", "SIZE 52428800"):
+                        self.reply(f"250-{extension}")
+                    self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == "AUTH":
+                self._auth(command)
+            elif verb == "MAIL":
+                sender = command[10:].strip()
+                recipients = []
+                self.reply("250 2.1.0 OK")
+            elif verb == "RCPT":
+                if server.error_rate and random.random() < server.error_rate:
+                    server.stats.add(transient_errors=1)
+                    self.reply("451 4.3.0 Temporary failure, try again later")
+                else:
+                    recipients.append(command[8:].strip())
+                    self.reply("250 2.1.5 OK")
+            elif verb == "DATA":
+                if sender is None or not recipients:
+                    self.reply("503 5.5.1 Need MAIL and RCPT first")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = self._read_data()
+                if server.latency:
+                    time.sleep(server.latency)
+                server.stats.add(messages=1, recipients=len(recipients), bytes=size, transactions=1)
+                sender, recipients = None, []
+                self.reply("250 2.0.0 OK queued")
+            elif verb == "RSET":
+                sender, recipients = None, []
+                self.reply("250 2.0.0 OK")
+            elif verb == "NOOP":
+                self.reply("250 2.0.0 OK")
+            elif verb == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("502 5.5.2 Command not recognized")
+
+    def _auth(self, command: str) -> None:
+        parts = command.split()
+        mechanism = parts[1].upper() if len(parts) > 1 else ""
+        if mechanism == "PLAIN" and len(parts) < 3:
+            self.reply("334 ")
+            self.rfile.readline()
+        elif mechanism == "LOGIN":
+            self.reply("334 " + base64.b64encode(b"Username:").decode())
+            self.rfile.readline()
+            self.reply("334 " + base64.b64encode(b"Password:").decode())
+            self.rfile.readline()
+        self.reply("235 2.7.0 Authentication successful")
+
+    def _read_data(self) -> int:
+        size = 0
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b".\r\n":
+                return size
+            size += len(line)
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    # Pools and engines connect all their sessions at once; the default backlog of 5 can stall a connect
+    request_queue_size = 128
+
+    def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 0), latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(address, SMTPSinkHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = SinkStats()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "SMTPSink":
+        """Serve from a background thread"""
+        threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local SMTP sink for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay before acknowledging each message")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of RCPT commands answered with 451")
+    args = parser.parse_args()
+    sink = SMTPSink((args.host, args.port), args.latency_ms / 1000, args.error_rate)
+    print(f"SMTP sink listening on {args.host}:{sink.port}")
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        print(sink.stats.as_dict())
+
+
+if __name__ == "__main__":
+    main()
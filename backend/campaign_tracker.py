@@ -2,61 +2,300 @@
 Campaign Tracker - Handles both temporary and permanent campaign status
 """
 
-import asyncio
-from typing import Dict, Optional
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 import logging
 
+from supabase_store import SupabaseStore
+
 logger = logging.getLogger(__name__)
 
+TERMINAL_STATUSES = ("completed", "completed_with_errors", "failed")
+
+# Persistence and retention defaults
+FLUSH_INTERVAL = float(os.getenv("CAMPAIGN_FLUSH_INTERVAL", "2"))
+FLUSH_BATCH_SIZE = int(os.getenv("CAMPAIGN_FLUSH_BATCH_SIZE", "100"))
+FINISHED_CAMPAIGN_TTL = float(os.getenv("FINISHED_CAMPAIGN_TTL", "900"))
+MAX_FINISHED_CAMPAIGNS = int(os.getenv("MAX_FINISHED_CAMPAIGNS", "500"))
+# Failed flushes after which a finished campaign is dropped from memory even though it was never persisted
+MAX_FLUSH_FAILURES = int(os.getenv("CAMPAIGN_MAX_FLUSH_FAILURES", "5"))
+
+
+class SupabaseCampaignStore(SupabaseStore):
+    """Persists campaign progress to the email_campaigns table, keyed by tracker_id"""
+
+    def save_many(self, rows: List[dict]) -> None:
+        """Upsert a batch of campaign rows in a single request"""
+        self.client.table("email_campaigns").upsert(rows, on_conflict="tracker_id").execute()
+
+    def load(self, campaign_id: str) -> Optional[dict]:
+        response = self.client.table("email_campaigns").select(
+            "status, progress, sent_count, failed_count, total_recipients, created_at"
+        ).eq("tracker_id", campaign_id).limit(1).execute()
+        if not response.data:
+            return None
+        row = response.data[0]
+        return {
+            "status": row["status"],
+            "total": row["total_recipients"],
+            "sent": row["sent_count"],
+            "failed": row["failed_count"],
+            "progress": float(row["progress"] or 0),
+            "created_at": row["created_at"],
+        }
+
+
 class CampaignTracker:
     """Tracks campaign status for both temporary and permanent campaigns"""
-    
-    def __init__(self):
+
+    def __init__(self, store: SupabaseCampaignStore = None, flush_interval: float = FLUSH_INTERVAL,
+                 flush_batch_size: int = FLUSH_BATCH_SIZE, finished_ttl: float = FINISHED_CAMPAIGN_TTL,
+                 max_finished: int = MAX_FINISHED_CAMPAIGNS, max_flush_failures: int = MAX_FLUSH_FAILURES):
         self.temp_campaigns: Dict[str, dict] = {}
-    
-    def create_temp_campaign(self, campaign_id: str, total_emails: int) -> None:
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.finished_ttl = finished_ttl
+        self.max_finished = max_finished
+        self.max_flush_failures = max_flush_failures
+        self._metadata: Dict[str, dict] = {}
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._dirty = set()
+        self._flush_failures: Dict[str, int] = {}
+        self._pending_updates = 0
+        self._lock = threading.Lock()
+        self._flush_needed = threading.Condition(self._lock)
+        # Per-campaign change counters that status streams wait on
+        self._versions: Dict[str, int] = {}
+        self._changed = threading.Condition(self._lock)
+        self._flusher: Optional[threading.Thread] = None
+
+    def attach_store(self, store: SupabaseCampaignStore) -> None:
+        """Persist campaign progress through the given store from now on"""
+        self.store = store
+
+    def create_temp_campaign(self, campaign_id: str, total_emails: int, user_id: str = None,
+                             template: dict = None) -> None:
         """Create a temporary campaign record"""
-        self.temp_campaigns[campaign_id] = {
-            "status": "pending",
-            "total": total_emails,
-            "sent": 0,
-            "failed": 0,
-            "progress": 0.0,
-            "created_at": datetime.utcnow()
-        }
+        template = template or {}
+        with self._lock:
+            self.temp_campaigns[campaign_id] = {
+                "status": "pending",
+                "total": total_emails,
+                "sent": 0,
+                "failed": 0,
+                "suppressed": 0,
+                "progress": 0.0,
+                "created_at": datetime.utcnow()
+            }
+            # A resumed campaign reuses its id; it must not be evicted as the finished run it replaces
+            self._finished.pop(campaign_id, None)
+            self._metadata[campaign_id] = {
+                "user_id": user_id,
+                "name": template.get("name") or campaign_id,
+                "subject": template.get("subject") or "",
+                "body": template.get("body") or "",
+            }
+            self._publish(campaign_id)
+            self._mark_dirty(campaign_id, urgent=True)
+            self._evict_finished()
         logger.info(f"Created temporary campaign {campaign_id} with {total_emails} emails")
-    
-    def update_temp_campaign(self, campaign_id: str, sent: int = None, failed: int = None, 
-                           status: str = None, progress: float = None) -> None:
+
+    def update_temp_campaign(self, campaign_id: str, sent: int = None, failed: int = None,
+                           status: str = None, progress: float = None, total: int = None) -> None:
         """Update a temporary campaign's status"""
-        if campaign_id in self.temp_campaigns:
-            campaign = self.temp_campaigns[campaign_id]
-            if sent is not None:
-                campaign["sent"] = sent
-            if failed is not None:
-                campaign["failed"] = failed
-            if status is not None:
-                campaign["status"] = status
-            if progress is not None:
-                campaign["progress"] = progress
-            
-            logger.info(f"Updated temp campaign {campaign_id}: {campaign}")
-    
+        with self._lock:
+            if campaign_id in self.temp_campaigns:
+                campaign = self.temp_campaigns[campaign_id]
+                if total is not None:
+                    campaign["total"] = total
+                if sent is not None:
+                    campaign["sent"] = sent
+                if failed is not None:
+                    campaign["failed"] = failed
+                if status is not None:
+                    campaign["status"] = status
+                if progress is not None:
+                    campaign["progress"] = progress
+
+                if campaign["status"] in TERMINAL_STATUSES:
+                    self._finished[campaign_id] = time.monotonic()
+                    self._finished.move_to_end(campaign_id)
+                else:
+                    self._finished.pop(campaign_id, None)
+                self._publish(campaign_id)
+                self._mark_dirty(campaign_id, urgent=status is not None)
+                logger.debug(f"Updated temp campaign {campaign_id}: {campaign}")
+
+    def record_temp_campaign_result(self, campaign_id: str, success: bool) -> None:
+        """Atomically count one sent or failed email, safe to call from concurrent workers"""
+        with self._lock:
+            campaign = self.temp_campaigns.get(campaign_id)
+            if campaign is None:
+                return
+            if success:
+                campaign["sent"] += 1
+            else:
+                campaign["failed"] += 1
+            if campaign["total"]:
+                campaign["progress"] = (campaign["sent"] + campaign["failed"]) / campaign["total"] * 100
+            self._publish(campaign_id)
+            self._mark_dirty(campaign_id)
+
+    def add_suppressed(self, campaign_id: str, count: int = 1) -> None:
+        """Count recipients skipped by the suppression list; they no longer count towards the total"""
+        with self._lock:
+            campaign = self.temp_campaigns.get(campaign_id)
+            if campaign is None or not count:
+                return
+            campaign["suppressed"] += count
+            if campaign["total"]:
+                campaign["total"] = max(0, campaign["total"] - count)
+                if campaign["total"]:
+                    campaign["progress"] = (campaign["sent"] + campaign["failed"]) / campaign["total"] * 100
+            self._publish(campaign_id)
+            self._mark_dirty(campaign_id)
+
     def get_temp_campaign_status(self, campaign_id: str) -> Optional[dict]:
-        """Get status of a temporary campaign"""
-        return self.temp_campaigns.get(campaign_id)
-    
+        """Get status of a temporary campaign, falling back to the store when it is not held in memory"""
+        with self._lock:
+            campaign = self.temp_campaigns.get(campaign_id)
+            if campaign is not None:
+                status = dict(campaign)
+                status["created_at"] = status["created_at"].isoformat()
+                return status
+        if self.store is None:
+            return None
+        try:
+            return self.store.load(campaign_id)
+        except Exception as e:
+            logger.error(f"Failed to load campaign {campaign_id} from store: {e}")
+            return None
+
+    def wait_for_change(self, campaign_id: str, version: int, timeout: float) -> Tuple[int, Optional[dict]]:
+        """Block until the campaign changes past `version` or timeout expires.
+
+        Returns the current (version, status). The version is unchanged on timeout, and the
+        status is None once the campaign is no longer held in memory.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._versions.get(campaign_id, 0) != version or campaign_id not in self.temp_campaigns,
+                timeout=timeout,
+            )
+            campaign = self.temp_campaigns.get(campaign_id)
+            if campaign is None:
+                return self._versions.get(campaign_id, 0), None
+            status = dict(campaign)
+            status["created_at"] = status["created_at"].isoformat()
+            return self._versions.get(campaign_id, 0), status
+
+    def running_throughput(self) -> List[Tuple[str, float]]:
+        """(campaign_id, emails processed per second since creation) for every running campaign"""
+        now = datetime.utcnow()
+        with self._lock:
+            return [
+                (campaign_id, (campaign["sent"] + campaign["failed"]) /
+                 max((now - campaign["created_at"]).total_seconds(), 1e-3))
+                for campaign_id, campaign in self.temp_campaigns.items()
+                if campaign["status"] == "running"
+            ]
+
     def complete_temp_campaign(self, campaign_id: str, sent: int, failed: int) -> None:
         """Mark a temporary campaign as completed"""
-        if campaign_id in self.temp_campaigns:
-            self.temp_campaigns[campaign_id].update({
-                "status": "completed",
-                "sent": sent,
-                "failed": failed,
-                "progress": 100.0
-            })
-            logger.info(f"Completed temp campaign {campaign_id}: {sent} sent, {failed} failed")
+        self.update_temp_campaign(campaign_id, sent=sent, failed=failed, status="completed", progress=100.0)
+        logger.info(f"Completed temp campaign {campaign_id}: {sent} sent, {failed} failed")
+
+    def flush(self) -> None:
+        """Write every campaign changed since the last flush to the store in one batch"""
+        with self._lock:
+            if self.store is None or not self._dirty:
+                return
+            dirty = list(self._dirty)
+            self._dirty.clear()
+            self._pending_updates = 0
+            rows = [self._row(campaign_id) for campaign_id in dirty if campaign_id in self.temp_campaigns]
+        try:
+            if rows:
+                self.store.save_many(rows)
+        except Exception as e:
+            logger.error(f"Failed to persist {len(rows)} campaign updates: {e}")
+            with self._lock:
+                self._dirty.update(dirty)
+                for campaign_id in dirty:
+                    self._flush_failures[campaign_id] = self._flush_failures.get(campaign_id, 0) + 1
+            return
+        with self._lock:
+            for campaign_id in dirty:
+                self._flush_failures.pop(campaign_id, None)
+
+    def _row(self, campaign_id: str) -> dict:
+        campaign = self.temp_campaigns[campaign_id]
+        row = dict(self._metadata.get(campaign_id, {}))
+        row.update({
+            "tracker_id": campaign_id,
+            "status": campaign["status"],
+            "progress": int(campaign["progress"]),
+            "sent_count": campaign["sent"],
+            "failed_count": campaign["failed"],
+            "total_recipients": campaign["total"],
+            "created_at": campaign["created_at"].isoformat(),
+            # Every row carries the same keys, since PostgREST rejects bulk upserts with mixed columns
+            "sent_at": datetime.utcnow().isoformat() if campaign["status"] in TERMINAL_STATUSES else None,
+        })
+        return row
+
+    def _publish(self, campaign_id: str) -> None:
+        # Called with the lock held; wakes status streams waiting on this campaign
+        self._versions[campaign_id] = self._versions.get(campaign_id, 0) + 1
+        self._changed.notify_all()
+
+    def _mark_dirty(self, campaign_id: str, urgent: bool = False) -> None:
+        # Called with the lock held; wakes the flusher on status changes or once enough updates pile up
+        if self.store is None:
+            return
+        self._dirty.add(campaign_id)
+        self._pending_updates += 1
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name="campaign-tracker-flush", daemon=True)
+            self._flusher.start()
+        if urgent or self._pending_updates >= self.flush_batch_size:
+            self._flush_needed.notify()
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._lock:
+                self._flush_needed.wait(timeout=self.flush_interval)
+            self.flush()
+            with self._lock:
+                self._evict_finished()
+
+    def _evict_finished(self) -> None:
+        # Called with the lock held; drops finished campaigns that are old or over the limit and already
+        # persisted, or that the store has refused too many times to keep holding on to
+        now = time.monotonic()
+        while self._finished:
+            campaign_id, finished_at = next(iter(self._finished.items()))
+            expired = now - finished_at > self.finished_ttl or len(self._finished) > self.max_finished
+            if not expired:
+                break
+            if campaign_id in self._dirty:
+                failures = self._flush_failures.get(campaign_id, 0)
+                if failures < self.max_flush_failures:
+                    break
+                logger.error(f"Dropping campaign {campaign_id} from memory after {failures} failed flushes; "
+                             f"its final status was not persisted")
+                self._dirty.discard(campaign_id)
+            del self._finished[campaign_id]
+            self._flush_failures.pop(campaign_id, None)
+            self.temp_campaigns.pop(campaign_id, None)
+            self._metadata.pop(campaign_id, None)
+            self._versions.pop(campaign_id, None)
+            self._changed.notify_all()
 
 # Global campaign tracker instance
-campaign_tracker = CampaignTracker() 
\ No newline at end of file
+campaign_tracker = CampaignTracker()
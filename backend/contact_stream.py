@@ -0,0 +1,183 @@
+"""
+Contact Stream - Reads contacts lazily from CSV files row by row for the send pipeline
+"""
+
+import csv
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import urllib.request
+import logging
+from typing import IO, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# CSV header spellings mapped to the contact keys used by templates
+HEADER_ALIASES = {
+    "e-mail": "email",
+    "email address": "email",
+    "full name": "name",
+    "jobtitle": "job_title",
+    "job title": "job_title",
+    "title": "job_title",
+    "company name": "company",
+    "organization": "company",
+}
+
+SIGNED_URL_EXPIRY_SECONDS = 600
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class IngestStats:
+    """Counters for rows read, skipped as invalid and dropped as duplicates"""
+
+    def __init__(self):
+        self.rows = 0
+        self.invalid = 0
+        self.duplicates = 0
+
+    @property
+    def accepted(self) -> int:
+        return self.rows - self.invalid - self.duplicates
+
+    def as_dict(self) -> dict:
+        return {"rows": self.rows, "invalid": self.invalid, "duplicates": self.duplicates,
+                "accepted": self.accepted}
+
+
+def email_digest(email: str) -> int:
+    """64-bit digest of a normalized address, used instead of the string in large seen-sets"""
+    return int.from_bytes(hashlib.blake2b(email.lower().encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def normalize_email(raw: str) -> Optional[str]:
+    """Return the normalized address, or None when it is not a valid email"""
+    from email_validator import EmailNotValidError, validate_email
+    try:
+        return validate_email(raw.strip(), check_deliverability=False).normalized
+    except (EmailNotValidError, AttributeError):
+        return None
+
+
+def _normalize_header(name: str) -> str:
+    key = (name or "").strip().lower()
+    return HEADER_ALIASES.get(key, key.replace(" ", "_"))
+
+
+def _read_header(reader) -> Optional[list]:
+    """Normalized header of a CSV, or None when the CSV is empty"""
+    try:
+        header = [_normalize_header(name) for name in next(reader)]
+    except StopIteration:
+        return None
+    if "email" not in header:
+        raise ValueError("CSV must have an email column")
+    return header
+
+
+def _iter_rows(reader, header: list, stats: IngestStats) -> Iterator[dict]:
+    seen = set()
+    for row in reader:
+        if not any(row):
+            continue
+        stats.rows += 1
+        contact = {key: value.strip() for key, value in zip(header, row) if key}
+        email = normalize_email(contact.get("email", ""))
+        if email is None:
+            stats.invalid += 1
+            continue
+        digest = email_digest(email)
+        if digest in seen:
+            stats.duplicates += 1
+            continue
+        seen.add(digest)
+        contact["email"] = email
+        contact.setdefault("name", "")
+        yield contact
+
+
+def iter_csv_contacts(stream: IO[str], stats: IngestStats = None) -> Iterator[dict]:
+    """Yield one normalized contact per valid, previously unseen row of a CSV text stream"""
+    reader = csv.reader(stream)
+    header = _read_header(reader)
+    if header is not None:
+        yield from _iter_rows(reader, header, stats or IngestStats())
+
+
+def iter_csv_file(path: str, stats: IngestStats = None, delete: bool = True) -> "CSVFileContacts":
+    """Stream contacts from a CSV file on disk, checking its header before returning
+
+    The file is opened and, with delete, unlinked straight away: the open handle keeps it
+    readable until the contacts are read or close() is called, so a campaign that never
+    starts reading does not leave it behind. Raises ValueError when the CSV has no email column.
+    """
+    f = open(path, "r", encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.reader(f)
+        header = _read_header(reader)
+    except Exception:
+        f.close()
+        if delete:
+            discard_upload(path)
+        raise
+    # Unlinking an open file fails on Windows; remove it on close instead
+    remove_after = delete and not discard_upload(path)
+    return CSVFileContacts(f, reader, header, stats or IngestStats(), path if remove_after else None)
+
+
+class CSVFileContacts:
+    """Contacts from an open CSV file; the file is closed once they are all read or on close()"""
+
+    def __init__(self, f: IO[str], reader, header: Optional[list], stats: IngestStats, remove_path: Optional[str]):
+        self._file = f
+        self._rows = _iter_rows(reader, header, stats) if header is not None else iter(())
+        self._remove_path = remove_path
+
+    def __iter__(self) -> "CSVFileContacts":
+        return self
+
+    def __next__(self) -> dict:
+        try:
+            return next(self._rows)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        self._file.close()
+        if self._remove_path:
+            discard_upload(self._remove_path)
+            self._remove_path = None
+
+
+def iter_storage_csv(client, bucket: str, path: str, stats: IngestStats = None) -> Iterator[dict]:
+    """Stream contacts from a CSV stored in Supabase Storage without downloading it first"""
+    signed = client.storage.from_(bucket).create_signed_url(path, SIGNED_URL_EXPIRY_SECONDS)
+    with urllib.request.urlopen(signed["signedURL"]) as response:
+        text = io.TextIOWrapper(response, encoding="utf-8-sig", newline="")
+        yield from iter_csv_contacts(text, stats)
+
+
+def save_upload(file_storage) -> str:
+    """Copy an uploaded CSV to a temporary file owned by the campaign, chunk by chunk"""
+    fd, path = tempfile.mkstemp(prefix="contacts_", suffix=".csv")
+    with os.fdopen(fd, "wb") as out:
+        shutil.copyfileobj(file_storage.stream, out, COPY_CHUNK_SIZE)
+    return path
+
+
+def discard_upload(path: str) -> bool:
+    """Remove a temporary CSV file, returning False if it could not be removed"""
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+def count_csv_rows(path: str) -> int:
+    """Count data rows without keeping them, to size campaign progress"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return max(0, sum(1 for row in csv.reader(f) if any(row)) - 1)
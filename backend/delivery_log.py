@@ -0,0 +1,128 @@
+"""
+Delivery Log - Append-only, batched record of per-recipient outcomes used to resume campaigns
+"""
+
+import os
+import threading
+import time
+import logging
+from typing import List, Optional, Set
+
+from contact_stream import email_digest
+from supabase_store import SupabaseStore
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_LOG_BATCH_SIZE = int(os.getenv("DELIVERY_LOG_BATCH_SIZE", "200"))
+DELIVERY_LOG_FLUSH_INTERVAL = float(os.getenv("DELIVERY_LOG_FLUSH_INTERVAL", "5"))
+# Consecutive failed writes after which a campaign stops logging deliveries, so its buffer cannot grow without bound
+DELIVERY_LOG_MAX_FAILURES = int(os.getenv("DELIVERY_LOG_MAX_FAILURES", "5"))
+PAGE_SIZE = 1000
+
+
+def digest_hex(email: str) -> str:
+    return f"{email_digest(email):016x}"
+
+
+class SupabaseDeliveryStore(SupabaseStore):
+    """Stores delivery outcomes in the campaign_deliveries table"""
+
+    def append(self, rows: List[dict]) -> None:
+        self.client.table("campaign_deliveries").insert(rows).execute()
+
+    def succeeded_digests(self, campaign_id: str) -> Set[int]:
+        """Digests of every recipient that already received this campaign"""
+        digests = set()
+        start = 0
+        while True:
+            response = self.client.table("campaign_deliveries").select("email_hash").eq(
+                "tracker_id", campaign_id
+            ).eq("outcome", "sent").order("id").range(start, start + PAGE_SIZE - 1).execute()
+            rows = response.data or []
+            digests.update(int(row["email_hash"], 16) for row in rows)
+            if len(rows) < PAGE_SIZE:
+                return digests
+            start += PAGE_SIZE
+
+
+class DeliveryLog:
+    """Buffers outcomes for one campaign and appends them to the store in batches"""
+
+    def __init__(self, campaign_id: str, store: SupabaseDeliveryStore, batch_size: int = DELIVERY_LOG_BATCH_SIZE,
+                 flush_interval: float = DELIVERY_LOG_FLUSH_INTERVAL, auto_flush: bool = True,
+                 max_failures: int = DELIVERY_LOG_MAX_FAILURES):
+        self.campaign_id = campaign_id
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.auto_flush = auto_flush
+        self.max_failures = max_failures
+        self._buffer: List[dict] = []
+        self._last_flush = time.monotonic()
+        self._failures = 0
+        self._disabled = False
+        self._flush_pending = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def record(self, index: int, email: str, success: bool, response: Optional[str] = None) -> None:
+        with self._lock:
+            if self._disabled:
+                return
+            self._buffer.append({
+                "tracker_id": self.campaign_id,
+                "contact_index": index,
+                "email_hash": digest_hex(email),
+                "outcome": "sent" if success else "failed",
+                "smtp_response": response[:500] if response else None,
+            })
+        if self.auto_flush and self.due():
+            self.flush()
+
+    def due(self) -> bool:
+        with self._lock:
+            if not self._buffer or self._flush_pending:
+                return False
+            # After a failed write only the interval counts, so a full buffer does not retry on every record
+            return (not self._failures and len(self._buffer) >= self.batch_size) or \
+                time.monotonic() - self._last_flush >= self.flush_interval
+
+    def claim_flush(self) -> bool:
+        """Like due(), but also marks a flush as pending until it runs, for callers that schedule it elsewhere"""
+        if not self.due():
+            return False
+        with self._lock:
+            if self._flush_pending:
+                return False
+            self._flush_pending = True
+            return True
+
+    def flush(self) -> None:
+        # One writer at a time so batches land in order; failed batches stay buffered for the next attempt
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+                self._last_flush = time.monotonic()
+                self._flush_pending = False
+            if not rows:
+                return
+            try:
+                self.store.append(rows)
+            except Exception as e:
+                with self._lock:
+                    self._failures += 1
+                    self._last_flush = time.monotonic()
+                    if self._failures >= self.max_failures:
+                        self._disabled = True
+                        self._buffer = []
+                        logger.error(f"Giving up on delivery records for {self.campaign_id} after {self._failures} "
+                                     f"failed writes; dropped {len(rows)}, and a resume may re-send to them: {e}")
+                        return
+                    self._buffer[:0] = rows
+                logger.error(f"Failed to write {len(rows)} delivery records for {self.campaign_id}: {e}")
+                return
+            with self._lock:
+                self._failures = 0
+
+    def close(self) -> None:
+        self.flush()
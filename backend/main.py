@@ -1,19 +1,35 @@
 import smtplib
 import ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
 import os
 import base64
+import hashlib
+import hmac
+import secrets
 from datetime import datetime
 import logging
 from dotenv import load_dotenv
 import functions_framework
-from supabase import create_client, Client
-import markdown
+from flask import Response
 import json
-from campaign_tracker import campaign_tracker
+import threading
+import time
+from campaign_tracker import campaign_tracker, SupabaseCampaignStore, TERMINAL_STATUSES
+from smtp_pool import SMTPConnectionPool, CONNECTION_ERRORS, warm_connection
+from batch_delivery import BATCH_DELIVERY_MODES, BATCH_RECIPIENT_HEADER, BatchSender, check_direct_mx_sender
+from account_sharding import (AccountSelector, FinishAggregator, SharedContactSource, ShardedPoolSender,
+                              account_weight, async_shares)
+from send_scheduler import (DailyQuotaExceeded, SupabaseQuotaStore, attach_quota_store, get_account_scheduler,
+                            transient_smtp_code)
+from ttl_cache import TTLCache
+from contact_stream import (IngestStats, count_csv_rows, discard_upload, email_digest, iter_csv_file, iter_storage_csv,
+                            save_upload)
+from delivery_log import DeliveryLog, SupabaseDeliveryStore
+from suppression import (SUPPRESSION_REASONS, SupabaseSuppressionStore, get_suppression_index, is_hard_bounce,
+                         suppression_cache)
+from template_engine import CompiledEmailTemplate, compile_email_template, preload as preload_templates
+from message_builder import PreparedAttachments, build_message, prepare_attachments
+from metrics import (Gauge, SamplingProfiler, emails_total, mime_build_seconds, registry, smtp_send_seconds,
+                     supabase_auth_seconds, supabase_settings_seconds, template_render_seconds)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,125 +42,408 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     raise ValueError("SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY must be set")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+# Created on first use so that cold starts serving requests without database access skip the client import
+supabase = None
+_supabase_lock = threading.Lock()
+
+def get_supabase():
+    global supabase
+    if supabase is None:
+        with _supabase_lock:
+            if supabase is None:
+                from supabase import create_client
+                supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    return supabase
+
+campaign_tracker.attach_store(SupabaseCampaignStore(get_supabase))
+delivery_store = SupabaseDeliveryStore(get_supabase)
+suppression_store = SupabaseSuppressionStore(get_supabase)
+attach_quota_store(SupabaseQuotaStore(get_supabase))
 
 # Default email configuration (fallback)
 DEFAULT_EMAIL_HOST = "smtp.gmail.com"
 DEFAULT_EMAIL_PORT = 587
 DEFAULT_EMAIL_DISPLAY_NAME = "Bulk Email Sender"
 
+# "threaded" runs each campaign on its own thread and connection pool; "async" shares one event loop
+SEND_ENGINE = os.getenv("SEND_ENGINE", "threaded").lower()
+# "single" sends one message per contact; "relay" or "mx" batch recipients of non-personalized templates
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "single").lower()
+
+# Caches for Supabase auth verification (keyed by token hash) and email_settings rows (keyed by user id)
+auth_cache = TTLCache("auth", maxsize=int(os.getenv("AUTH_CACHE_SIZE", "1024")),
+                      ttl=float(os.getenv("AUTH_CACHE_TTL", "60")))
+settings_cache = TTLCache("email_settings", maxsize=int(os.getenv("SETTINGS_CACHE_SIZE", "1024")),
+                          ttl=float(os.getenv("SETTINGS_CACHE_TTL", "300")))
+# Collapsed stacks from campaigns started with "profile": true
+campaign_profiles = TTLCache("campaign_profiles", maxsize=32, ttl=float(os.getenv("PROFILE_RETENTION", "3600")))
+# Status streams push at most one update per SSE_MIN_INTERVAL, send a comment line when idle for
+# SSE_HEARTBEAT_INTERVAL, and close after SSE_MAX_DURATION so EventSource reconnects within the function timeout
+SSE_MIN_INTERVAL = float(os.getenv("SSE_MIN_INTERVAL", "0.5"))
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
+SSE_MAX_DURATION = float(os.getenv("SSE_MAX_DURATION", "300"))
+# Bearer token for scraping /api/metrics; the endpoint is disabled until it is set, since labels carry user ids
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+registry.register(Gauge(
+    "emailer_campaign_emails_per_second", "Emails processed per second by each running campaign",
+    lambda: (({"campaign_id": campaign_id}, rate) for campaign_id, rate in campaign_tracker.running_throughput())))
+registry.register(Gauge(
+    "emailer_cache_hit_ratio", "Hit ratio of the in-process Supabase caches",
+    lambda: (({"cache": cache.name}, cache.stats()["hit_ratio"]) for cache in (auth_cache, settings_cache, suppression_cache))))
+
+def token_cache_ttl(token):
+    """Cache lifetime for a verified token, never past its own exp claim"""
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return max(0.0, min(auth_cache.ttl, claims["exp"] - datetime.now().timestamp()))
+    except Exception:
+        return auth_cache.ttl
+
 # Authentication function
-def get_current_user(request):
+def get_current_user(request, allow_query_token=False):
     try:
         auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
+        if auth_header and auth_header.startswith('Bearer '):
+            token = auth_header.split(' ')[1]
+        elif allow_query_token and request.args.get('access_token'):
+            # EventSource cannot set headers, so event streams pass the token in the query string
+            token = request.args['access_token']
+        else:
             raise Exception("No valid authorization header")
-        token = auth_header.split(' ')[1]
-        user_response = supabase.auth.get_user(token)
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        user = auth_cache.get(token_hash)
+        if user is not None:
+            return user
+        with supabase_auth_seconds.time():
+            user_response = get_supabase().auth.get_user(token)
         if not user_response.user:
             raise Exception("Invalid authentication credentials")
+        auth_cache.set(token_hash, user_response.user, ttl=token_cache_ttl(token))
         return user_response.user
     except Exception as e:
         logger.error(f"Authentication error: {e}")
         return None
 
 # Function to get user's email settings
-def get_user_email_settings(user_id):
+def get_user_sending_accounts(user_id):
+    """Every active sending account of the user, oldest (the primary account) first"""
+    accounts = settings_cache.get(user_id)
+    if accounts is not None:
+        return accounts
     try:
-        response = supabase.table("email_settings").select("*").eq("user_id", user_id).eq("is_active", True).execute()
-        if response.data and len(response.data) > 0:
-            return response.data[0]
-        return None
+        with supabase_settings_seconds.time():
+            response = get_supabase().table("email_settings").select("*").eq("user_id", user_id).eq(
+                "is_active", True
+            ).order("created_at").execute()
+        if response.data:
+            settings_cache.set(user_id, response.data)
+            return response.data
+        return []
     except Exception as e:
         logger.error(f"Error fetching user email settings: {e}")
-        return None
+        return []
+
+def get_user_email_settings(user_id):
+    accounts = get_user_sending_accounts(user_id)
+    return accounts[0] if accounts else None
+
+# Build the raw message bytes for one contact
+def build_email_message(contact, template, user_settings, attachments=[]):
+    if not isinstance(template, CompiledEmailTemplate):
+        template = compile_email_template(template)
+    if not isinstance(attachments, PreparedAttachments):
+        attachments = prepare_attachments(attachments)
+    started = time.perf_counter()
+    text = template.text.render(contact)
+    html = template.html.render(contact)
+    rendered = time.perf_counter()
+    template_render_seconds.observe(rendered - started)
+    message = build_message(
+        template.subject,
+        f"{user_settings['email_display_name']} <{user_settings['email_user']}>",
+        contact["email"],
+        text,
+        html,
+        attachments,
+    )
+    mime_build_seconds.observe(time.perf_counter() - rendered)
+    return message
 
 # Email sending function with user-specific settings
 def send_single_email(contact, template, smtp_server, user_settings, attachments=[]):
     try:
-        msg = MIMEMultipart("alternative")
-        msg["Subject"] = template["subject"]
-        msg["From"] = f"{user_settings['email_display_name']} <{user_settings['email_user']}>"
-        msg["To"] = contact["email"]
-        personalized_body = template["body"].replace("{name}", contact["name"])
-        personalized_body = personalized_body.replace("{email}", contact["email"])
-        if contact.get("company"):
-            personalized_body = personalized_body.replace("{company}", contact["company"])
-        if contact.get("job_title"):
-            personalized_body = personalized_body.replace("{jobTitle}", contact["job_title"])
-        text = personalized_body
-        if personalized_body.startswith("<") and personalized_body.endswith(">"):
-            html = personalized_body
-        else:
-            html = markdown.markdown(personalized_body, extensions=['extra'])
-        part1 = MIMEText(text, "plain")
-        part2 = MIMEText(html, "html")
-        msg.attach(part1)
-        msg.attach(part2)
-        for attachment in attachments:
-            try:
-                file_content = base64.b64decode(attachment["content"])
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(file_content)
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', f'attachment; filename= {attachment["filename"]}')
-                msg.attach(part)
-            except Exception as e:
-                logger.error(f"Failed to attach file {attachment['filename']}: {e}")
-        smtp_server.sendmail(user_settings['email_user'], contact["email"], msg.as_string())
+        message = build_email_message(contact, template, user_settings, attachments)
+        started = time.perf_counter()
+        smtp_server.sendmail(user_settings['email_user'], contact["email"], message)
+        smtp_send_seconds.observe(time.perf_counter() - started)
         return True
+    except CONNECTION_ERRORS:
+        # Let the connection pool reconnect and retry this contact
+        raise
+    except smtplib.SMTPRecipientsRefused:
+        # The pool retries temporary refusals and records the reply of permanent ones (hard bounces)
+        raise
     except Exception as e:
+        if transient_smtp_code(e):
+            # Temporary (4xx) replies are retried by the pool with backoff
+            raise
         logger.error(f"Failed to send email to {contact['email']}: {e}")
         return False
 
-def send_bulk_emails_task(campaign_id, contacts, template, user_id, attachments=[]):
+def requested_delivery(value, user_settings):
+    """Validate the delivery mode asked for by a send request, defaulting to DELIVERY_MODE"""
+    mode = (value or DELIVERY_MODE).lower()
+    if mode != "single" and mode not in BATCH_DELIVERY_MODES:
+        raise ValueError(f"delivery must be one of single, {', '.join(BATCH_DELIVERY_MODES)}")
+    if mode == "mx":
+        check_direct_mx_sender(user_settings.get("email_user"))
+    return mode
+
+def new_campaign_id(user_id):
+    """Tracker id for a new campaign; the random part keeps two campaigns started in the same second apart"""
+    return f"temp_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(4)}_{user_id}"
+
+def send_bulk_emails_task(campaign_id, contacts, template, user_id, attachments=[], user_settings=None, resume=False,
+                          ingest_stats=None, engine=None, profile=False, delivery="single"):
+    """Run a campaign on the thread pool, or hand it to the async engine when one is given"""
+    is_temp_campaign = campaign_id.startswith("temp_")
+    profiler = None
+
+    def close_contacts():
+        # Releases an uploaded CSV even when the campaign stops before reading it
+        close = getattr(contacts, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                logger.error(f"Failed to close contacts of campaign {campaign_id}: {e}")
+
     try:
-        logger.info(f"Starting email campaign {campaign_id} for {len(contacts)} contacts")
+        if isinstance(contacts, list):
+            logger.info(f"Starting email campaign {campaign_id} for {len(contacts)} contacts")
+        else:
+            logger.info(f"Starting email campaign {campaign_id} for streamed contacts")
         
-        # Get user's email settings
-        user_settings = get_user_email_settings(user_id)
+        # Get user's sending accounts; several active accounts share the campaign between them
+        accounts = get_user_sending_accounts(user_id)
+        if user_settings is not None and user_settings not in accounts:
+            accounts = [user_settings]
+        user_settings = accounts[0] if accounts else None
         if not user_settings:
             logger.error(f"No email settings found for user {user_id}")
-            if campaign_id.startswith("temp_"):
+            close_contacts()
+            if is_temp_campaign:
                 campaign_tracker.update_temp_campaign(campaign_id, status="failed", progress=0.0)
             return
         
-        is_temp_campaign = campaign_id.startswith("temp_")
+        work = enumerate(contacts)
+        already_sent = 0
+        if resume:
+            # Skip everyone the delivery log says already received this campaign
+            delivered = delivery_store.succeeded_digests(campaign_id)
+            already_sent = len(delivered)
+            work = ((index, contact) for index, contact in work if email_digest(contact["email"]) not in delivered)
+            logger.info(f"Resuming campaign {campaign_id}, skipping {already_sent} delivered recipients")
+        try:
+            suppressed = get_suppression_index(suppression_store, user_id)
+        except Exception as e:
+            # Sending without the list beats failing every campaign while the table is unavailable
+            logger.error(f"Could not load suppression list for user {user_id}: {e}")
+            suppressed = None
+        if suppressed:
+            if isinstance(contacts, list):
+                # Screen the whole list up front so the tracker total excludes suppressed recipients from the start
+                work = list(work)
+                screened = suppressed.screen_all(work)
+                campaign_tracker.add_suppressed(campaign_id, len(work) - len(screened))
+                logger.info(f"Campaign {campaign_id} skipping {len(work) - len(screened)} suppressed recipients")
+                work = screened
+            else:
+                work = suppressed.screen(work, lambda: campaign_tracker.add_suppressed(campaign_id))
         if is_temp_campaign:
-            campaign_tracker.update_temp_campaign(campaign_id, status="running", progress=0.0)
+            campaign_tracker.update_temp_campaign(campaign_id, status="running", progress=0.0, sent=already_sent)
         
-        context = ssl.create_default_context()
-        with smtplib.SMTP(user_settings['email_host'], user_settings['email_port']) as server:
-            server.starttls(context=context)
-            server.login(user_settings['email_user'], user_settings['email_password'])
-            sent_count = 0
-            failed_count = 0
-            for i, contact in enumerate(contacts):
+        compiled_template = compile_email_template(template)
+        prepared_attachments = prepare_attachments(attachments)
+        batched = delivery in BATCH_DELIVERY_MODES and engine is None
+        if batched and compiled_template.is_personalized:
+            logger.info(f"Campaign {campaign_id} template is personalized; sending one message per contact")
+            batched = False
+        scheduler = get_account_scheduler(user_settings)
+        delivery_log = DeliveryLog(campaign_id, delivery_store, auto_flush=engine is None)
+        bounced = []
+        if profile:
+            # The async engine runs every campaign on one thread, so its profile includes concurrent campaigns
+            profiler = SamplingProfiler("async-smtp-engine" if engine is not None else f"{campaign_id}-worker").start()
+
+        def on_result(index, contact, success, response):
+            emails_total.inc(outcome="sent" if success else "failed")
+            delivery_log.record(index, contact["email"], success, response)
+            if not success and is_hard_bounce(response):
+                bounced.append(contact["email"])
+            if engine is not None and delivery_log.claim_flush():
+                # Runs on the event loop; write the batch from the default executor instead
+                import asyncio
+                asyncio.get_running_loop().run_in_executor(None, delivery_log.flush)
+            if is_temp_campaign:
+                campaign_tracker.record_temp_campaign_result(campaign_id, success)
+
+        def on_finish(sent_count, failed_count, error=None):
+            delivery_log.close()
+            close_contacts()
+            if bounced:
+                # Hard-bounced addresses are left out of this user's future campaigns
                 try:
-                    success = send_single_email(contact, template, server, user_settings, attachments)
-                    if success:
-                        sent_count += 1
-                    else:
-                        failed_count += 1
-                    progress = (i + 1) / len(contacts) * 100
-                    if is_temp_campaign:
-                        campaign_tracker.update_temp_campaign(
-                            campaign_id, status="running", progress=progress, sent=sent_count, failed=failed_count
-                        )
+                    suppression_store.add(user_id, bounced, "bounce", tracker_id=campaign_id)
+                    suppression_cache.invalidate(user_id)
                 except Exception as e:
-                    logger.error(f"Error sending to {contact['email']}: {e}")
-                    failed_count += 1
+                    logger.error(f"Failed to record {len(bounced)} bounces for {campaign_id}: {e}")
+            if profiler is not None:
+                profiler.stop()
+                campaign_profiles.set(campaign_id, profiler.collapsed())
+            if error is not None:
+                logger.error(f"Campaign {campaign_id} failed: {error}")
+                if is_temp_campaign:
+                    campaign_tracker.update_temp_campaign(campaign_id, status="failed")
+                return
+            sent_count += already_sent
             final_status = "completed" if failed_count == 0 else "completed_with_errors"
             if is_temp_campaign:
                 campaign_tracker.update_temp_campaign(
-                    campaign_id, status=final_status, progress=100.0, sent=sent_count, failed=failed_count
+                    campaign_id, status=final_status, progress=100.0, sent=sent_count, failed=failed_count,
+                    total=sent_count + failed_count
                 )
             logger.info(f"Campaign {campaign_id} completed: {sent_count} sent, {failed_count} failed")
+            if ingest_stats is not None:
+                logger.info(f"Campaign {campaign_id} CSV ingestion: {ingest_stats.as_dict()}")
+
+        def build_fn_for(settings):
+            return lambda contact: build_email_message(contact, compiled_template, settings, prepared_attachments)
+
+        def send_fn_for(settings):
+            return lambda contact, server: send_single_email(contact, compiled_template, server, settings,
+                                                             prepared_attachments)
+
+        if engine is not None:
+            from async_engine import AsyncCampaign
+            if len(accounts) == 1:
+                engine.submit(AsyncCampaign(campaign_id, user_id, user_settings, work, build_fn_for(user_settings),
+                                            on_result, on_finish, scheduler))
+                return
+            # One engine entry per unit of weight, all drawing on the same contacts
+            schedulers = [get_account_scheduler(settings) for settings in accounts]
+            source = SharedContactSource(work, AccountSelector([account_weight(settings) for settings in accounts],
+                                                               [s.remaining_today() for s in schedulers]))
+            shares = async_shares(accounts)
+            finish = FinishAggregator(sum(shares), on_finish)
+            logger.info(f"Campaign {campaign_id} sharded across {len(accounts)} accounts with shares {shares}")
+            for account, settings in enumerate(accounts):
+                for _ in range(shares[account]):
+                    engine.submit(AsyncCampaign(campaign_id, user_id, settings, source.iterator(account),
+                                                build_fn_for(settings), on_result, finish, schedulers[account]))
+            return
+
+        if batched:
+            # Every recipient gets the same bytes, so build the message once and send it in batches by domain
+            if len(accounts) > 1:
+                logger.info(f"Campaign {campaign_id} batch delivery sends from the primary account only")
+            message = build_email_message({"email": BATCH_RECIPIENT_HEADER}, compiled_template, user_settings,
+                                          prepared_attachments)
+            sender = BatchSender(user_settings, message, mode=delivery, scheduler=scheduler, name=campaign_id)
+            try:
+                sent_count, failed_count = sender.send_all(work, on_result)
+            except DailyQuotaExceeded as e:
+                # Out of daily quota; the tracker keeps its counts and a resume sends the rest
+                on_finish(0, 0, e)
+                return
+            finally:
+                delivery_log.close()
+            on_finish(sent_count, failed_count)
+            return
+
+        if len(accounts) == 1:
+            sender = SMTPConnectionPool(user_settings, scheduler=scheduler, name=campaign_id)
+            send_fn = send_fn_for(user_settings)
+        else:
+            logger.info(f"Campaign {campaign_id} sharded across {len(accounts)} accounts")
+            sender = ShardedPoolSender(accounts, [get_account_scheduler(settings) for settings in accounts],
+                                       name=campaign_id)
+            send_fn = send_fn_for
+        try:
+            sent_count, failed_count = sender.send_all(work, send_fn, on_result)
+        except DailyQuotaExceeded as e:
+            # Out of daily quota; the tracker keeps its counts and a resume sends the rest
+            on_finish(0, 0, e)
+            return
+        finally:
+            delivery_log.close()
+        on_finish(sent_count, failed_count)
     except Exception as e:
+        if profiler is not None:
+            profiler.stop()
+        close_contacts()
         logger.error(f"Campaign {campaign_id} failed: {e}")
-        if campaign_id.startswith("temp_"):
+        if is_temp_campaign:
             campaign_tracker.update_temp_campaign(campaign_id, status="failed", progress=0.0)
 
+def launch_campaign(campaign_id, contacts, template, user_id, attachments=[], **kwargs):
+    """Start a campaign on the configured engine: a thread per campaign, or the shared async engine"""
+    # Batch delivery always runs on its own thread
+    if SEND_ENGINE == "async" and kwargs.get("delivery", "single") not in BATCH_DELIVERY_MODES:
+        from async_engine import get_async_engine
+        send_bulk_emails_task(campaign_id, contacts, template, user_id, attachments,
+                              engine=get_async_engine(), **kwargs)
+        return
+    thread = threading.Thread(
+        target=send_bulk_emails_task,
+        args=(campaign_id, contacts, template, user_id, attachments),
+        kwargs=kwargs
+    )
+    thread.start()
+
+def campaign_events(campaign_id):
+    """Server-Sent Events stream of a campaign's status, ending once it reaches a terminal status"""
+    deadline = time.monotonic() + SSE_MAX_DURATION
+    version = -1
+    yield f"retry: {int(SSE_MIN_INTERVAL * 4000)}\n\n"
+    while time.monotonic() < deadline:
+        new_version, status = campaign_tracker.wait_for_change(campaign_id, version, SSE_HEARTBEAT_INTERVAL)
+        if status is None:
+            # Not held in this instance's memory: send the persisted state, if any. Only a finished campaign
+            # ends the stream; otherwise it runs elsewhere, so tell the client to poll /status instead
+            status = campaign_tracker.get_temp_campaign_status(campaign_id)
+            if status:
+                yield f"event: status\ndata: {json.dumps(status)}\n\n"
+            if status and status["status"] in TERMINAL_STATUSES:
+                yield "event: end\ndata: {}\n\n"
+            else:
+                yield "event: poll\ndata: {}\n\n"
+            return
+        if new_version == version:
+            yield ": heartbeat\n\n"
+            continue
+        version = new_version
+        yield f"id: {version}\nevent: status\ndata: {json.dumps(status)}\n\n"
+        if status["status"] in TERMINAL_STATUSES:
+            yield "event: end\ndata: {}\n\n"
+            return
+        # Coalesce: everything that changes while we sleep goes out as one event
+        time.sleep(SSE_MIN_INTERVAL)
+
+def warm_up(user_settings):
+    """Prepare what the next send for this account needs: the markdown renderer and an SMTP session"""
+    preload_templates()
+    try:
+        if SEND_ENGINE == "async":
+            import async_engine  # noqa: F401
+            import aiosmtplib  # noqa: F401
+            return
+        warm_connection(user_settings)
+    except Exception as e:
+        logger.warning(f"Warm-up for {user_settings.get('email_user')} failed: {e}")
+
 @functions_framework.http
 def email_api(request):
     # Set CORS headers for the preflight request
@@ -171,6 +470,29 @@ def email_api(request):
             if not user:
                 return json.dumps({"error": "Invalid authentication"}), 401, headers
             return json.dumps({"message": "Authentication successful", "user_id": user.id}), 200, headers
+        elif path == "/api/metrics" and method == "GET":
+            if not METRICS_TOKEN:
+                return json.dumps({"error": "Metrics are disabled; set METRICS_TOKEN to enable them"}), 404, headers
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            return registry.render(), 200, {**headers, 'Content-Type': 'text/plain; version=0.0.4'}
+        elif path == "/api/warmup" and method == "POST":
+            # Sent when the user opens the send dialog; authenticating already builds the Supabase client
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            accounts = get_user_sending_accounts(user.id)
+            if not accounts:
+                return json.dumps({"warmed": False}), 200, headers
+            for user_settings in accounts:
+                threading.Thread(target=warm_up, args=(user_settings,), daemon=True).start()
+            return json.dumps({"warmed": True, "accounts": len(accounts)}), 202, headers
+        elif path == "/api/cache/stats" and method == "GET":
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            caches = (auth_cache, settings_cache, suppression_cache)
+            return json.dumps({cache.name: cache.stats() for cache in caches}), 200, headers
         elif path == "/api/email-settings" and method == "GET":
             user = get_current_user(request)
             if not user:
@@ -206,16 +528,36 @@ def email_api(request):
                     "email_display_name": data.get("email_display_name", DEFAULT_EMAIL_DISPLAY_NAME),
                     "is_active": True
                 }
+                if "weight" in data:
+                    # Share of each campaign this account sends when the user has several; 0 pauses it
+                    try:
+                        weight = float(data["weight"])
+                    except (TypeError, ValueError):
+                        weight = None
+                    if weight is None or weight < 0:
+                        return json.dumps({"error": "weight must be a number >= 0"}), 400, headers
+                    settings_data["weight"] = weight
                 
                 if not settings_data["email_user"] or not settings_data["email_password"]:
                     return json.dumps({"error": "Email user and password are required"}), 400, headers
                 
-                if existing_settings:
-                    # Update existing settings
-                    response = supabase.table("email_settings").update(settings_data).eq("user_id", user.id).execute()
+                if data.get("id"):
+                    # Update one specific sending account
+                    response = get_supabase().table("email_settings").update(settings_data).eq(
+                        "id", data["id"]
+                    ).eq("user_id", user.id).execute()
+                    if not response.data:
+                        settings_cache.invalidate(user.id)
+                        return json.dumps({"error": "Sending account not found"}), 404, headers
+                elif existing_settings and not data.get("add_account"):
+                    # Update the primary account
+                    response = get_supabase().table("email_settings").update(settings_data).eq(
+                        "id", existing_settings["id"]
+                    ).execute()
                 else:
                     # Create new settings
-                    response = supabase.table("email_settings").insert(settings_data).execute()
+                    response = get_supabase().table("email_settings").insert(settings_data).execute()
+                settings_cache.invalidate(user.id)
                 
                 if response.data:
                     # Don't return the password
@@ -226,6 +568,28 @@ def email_api(request):
             except Exception as e:
                 logger.error(f"Error saving email settings: {e}")
                 return json.dumps({"error": "Failed to save email settings"}), 500, headers
+        elif path == "/api/email-settings/accounts" and method == "GET":
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            accounts = [{k: v for k, v in settings.items() if k != 'email_password'}
+                        for settings in get_user_sending_accounts(user.id)]
+            for account in accounts:
+                account["remaining_today"] = get_account_scheduler(account).remaining_today()
+            return json.dumps({"accounts": accounts}, default=str), 200, headers
+        elif path.startswith("/api/email-settings/") and method == "DELETE":
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            account_id = path.split("/")[-1]
+            # Deactivate rather than delete, so past campaigns keep their sender
+            response = get_supabase().table("email_settings").update({"is_active": False}).eq(
+                "id", account_id
+            ).eq("user_id", user.id).execute()
+            settings_cache.invalidate(user.id)
+            if not response.data:
+                return json.dumps({"error": "Sending account not found"}), 404, headers
+            return json.dumps({"message": "Sending account removed"}), 200, headers
         elif path == "/api/email-settings/test" and method == "POST":
             user = get_current_user(request)
             if not user:
@@ -248,6 +612,8 @@ def email_api(request):
                     server.starttls(context=context)
                     server.login(email_user, email_password)
                     # Try to send a test email to the user's own email
+                    from email.mime.text import MIMEText
+                    from email.mime.multipart import MIMEMultipart
                     test_msg = MIMEMultipart("alternative")
                     test_msg["Subject"] = "Email Settings Test"
                     test_msg["From"] = f"{data.get('email_display_name', DEFAULT_EMAIL_DISPLAY_NAME)} <{email_user}>"
@@ -271,26 +637,168 @@ def email_api(request):
             user_settings = get_user_email_settings(user.id)
             if not user_settings:
                 return json.dumps({"error": "Please configure your email settings first"}), 400, headers
+            try:
+                delivery = requested_delivery(data.get("delivery"), user_settings)
+            except ValueError as e:
+                return json.dumps({"error": str(e)}), 400, headers
             
-            campaign_id = f"temp_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{user.id}"
-            campaign_tracker.create_temp_campaign(campaign_id, len(data.get("contacts", [])))
-            import threading
-            thread = threading.Thread(
-                target=send_bulk_emails_task,
-                args=(campaign_id, data.get("contacts", []), data.get("template", {}), user.id, data.get("attachments", []))
-            )
-            thread.start()
+            campaign_id = new_campaign_id(user.id)
+            campaign_tracker.create_temp_campaign(campaign_id, len(data.get("contacts", [])), user_id=user.id,
+                                                  template=data.get("template", {}))
+            launch_campaign(campaign_id, data.get("contacts", []), data.get("template", {}), user.id,
+                            data.get("attachments", []), user_settings=user_settings,
+                            profile=bool(data.get("profile")), delivery=delivery)
             return json.dumps({
                 "message": "Email campaign started",
                 "campaign_id": campaign_id,
                 "total_contacts": len(data.get("contacts", []))
             }), 200, headers
-        elif path.startswith("/api/campaigns/") and path.endswith("/status") and method == "GET":
+        elif path == "/api/send-emails/csv" and method == "POST":
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            user_settings = get_user_email_settings(user.id)
+            if not user_settings:
+                return json.dumps({"error": "Please configure your email settings first"}), 400, headers
+
+            stats = IngestStats()
+            upload = request.files.get("file")
+            try:
+                if upload:
+                    # Multipart upload: template and attachments arrive as JSON form fields
+                    template = json.loads(request.form.get("template") or "{}")
+                    attachments = json.loads(request.form.get("attachments") or "[]")
+                    delivery = requested_delivery(request.form.get("delivery"), user_settings)
+                    csv_path = save_upload(upload)
+                    try:
+                        total_contacts = count_csv_rows(csv_path)
+                        # Checks the header now, so a CSV without an email column is a 400 rather than a failed campaign
+                        contacts = iter_csv_file(csv_path, stats)
+                    except ValueError:
+                        discard_upload(csv_path)
+                        raise
+                else:
+                    # Reference to a CSV in Supabase Storage under the user's own folder
+                    data = request.get_json(silent=True) or {}
+                    source = data.get("csv") or {}
+                    bucket, storage_path = source.get("bucket"), source.get("path")
+                    if not bucket or not storage_path:
+                        return json.dumps({"error": "Provide a CSV file upload or a csv bucket and path"}), 400, headers
+                    if not storage_path.startswith(f"{user.id}/"):
+                        return json.dumps({"error": "CSV path must be inside your own folder"}), 403, headers
+                    template = data.get("template", {})
+                    attachments = data.get("attachments", [])
+                    delivery = requested_delivery(data.get("delivery"), user_settings)
+                    total_contacts = 0
+                    contacts = iter_storage_csv(get_supabase(), bucket, storage_path, stats)
+            except ValueError as e:
+                return json.dumps({"error": f"Invalid request: {e}"}), 400, headers
+
+            campaign_id = new_campaign_id(user.id)
+            campaign_tracker.create_temp_campaign(campaign_id, total_contacts, user_id=user.id, template=template)
+            launch_campaign(campaign_id, contacts, template, user.id, attachments,
+                            user_settings=user_settings, ingest_stats=stats, delivery=delivery)
+            return json.dumps({
+                "message": "Email campaign started",
+                "campaign_id": campaign_id,
+                "total_contacts": total_contacts
+            }), 200, headers
+        elif path.startswith("/api/campaigns/") and path.endswith("/resume") and method == "POST":
             user = get_current_user(request)
             if not user:
                 return json.dumps({"error": "Invalid authentication"}), 401, headers
             campaign_id = path.split("/")[-2]
+            if not campaign_id.endswith(f"_{user.id}"):
+                return json.dumps({"error": "Campaign not found"}), 404, headers
+            data = request.get_json()
+            if not data:
+                return json.dumps({"error": "No data provided"}), 400, headers
+            user_settings = get_user_email_settings(user.id)
+            if not user_settings:
+                return json.dumps({"error": "Please configure your email settings first"}), 400, headers
             status = campaign_tracker.get_temp_campaign_status(campaign_id)
+            if status and status["status"] in ("pending", "running") and campaign_id in campaign_tracker.temp_campaigns:
+                return json.dumps({"error": "Campaign is still running"}), 409, headers
+
+            # The client sends the same contacts (or CSV reference) and template as the original campaign
+            stats = IngestStats()
+            source = data.get("csv") or {}
+            if source:
+                if not source.get("bucket") or not str(source.get("path", "")).startswith(f"{user.id}/"):
+                    return json.dumps({"error": "CSV path must be inside your own folder"}), 403, headers
+                contacts = iter_storage_csv(get_supabase(), source["bucket"], source["path"], stats)
+                total_contacts = status["total"] if status else 0
+            else:
+                contacts = data.get("contacts", [])
+                total_contacts = len(contacts)
+            template = data.get("template", {})
+            try:
+                delivery = requested_delivery(data.get("delivery"), user_settings)
+            except ValueError as e:
+                return json.dumps({"error": str(e)}), 400, headers
+            campaign_tracker.create_temp_campaign(campaign_id, total_contacts, user_id=user.id, template=template)
+            launch_campaign(campaign_id, contacts, template, user.id, data.get("attachments", []),
+                            user_settings=user_settings, resume=True, ingest_stats=stats if source else None,
+                            delivery=delivery)
+            return json.dumps({
+                "message": "Email campaign resumed",
+                "campaign_id": campaign_id,
+                "total_contacts": total_contacts
+            }), 200, headers
+        elif path.startswith("/api/campaigns/") and path.endswith("/profile") and method == "GET":
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            campaign_id = path.split("/")[-2]
+            collapsed = campaign_profiles.get(campaign_id) if campaign_id.endswith(f"_{user.id}") else None
+            if collapsed is None:
+                return json.dumps({"error": "No profile for this campaign"}), 404, headers
+            return collapsed, 200, {**headers, 'Content-Type': 'text/plain'}
+        elif path == "/api/suppressions" and method == "GET":
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            limit = min(int(request.args.get("limit", 100)), 1000)
+            offset = int(request.args.get("offset", 0))
+            response = get_supabase().table("email_suppressions").select("email, reason, tracker_id, created_at").eq(
+                "user_id", user.id
+            ).order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+            return json.dumps({"suppressions": response.data or []}), 200, headers
+        elif path == "/api/suppressions" and method in ("POST", "DELETE"):
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            data = request.get_json(silent=True) or {}
+            emails = [email for email in data.get("emails", []) if isinstance(email, str) and "@" in email]
+            if not emails:
+                return json.dumps({"error": "Provide a list of emails"}), 400, headers
+            if method == "POST":
+                reason = data.get("reason", "manual")
+                if reason not in SUPPRESSION_REASONS:
+                    return json.dumps({"error": f"reason must be one of {', '.join(SUPPRESSION_REASONS)}"}), 400, headers
+                count = suppression_store.add(user.id, emails, reason)
+            else:
+                suppression_store.remove(user.id, emails)
+                count = len(emails)
+            suppression_cache.invalidate(user.id)
+            return json.dumps({"message": "Suppression list updated", "count": count}), 200, headers
+        elif path.startswith("/api/campaigns/") and path.endswith("/events") and method == "GET":
+            # Authenticated once here; the stream itself makes no further Supabase calls
+            user = get_current_user(request, allow_query_token=True)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            campaign_id = path.split("/")[-2]
+            if not campaign_id.endswith(f"_{user.id}") or not campaign_tracker.get_temp_campaign_status(campaign_id):
+                return json.dumps({"error": "Campaign not found"}), 404, headers
+            return Response(campaign_events(campaign_id), mimetype="text/event-stream", headers={
+                **headers, 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'
+            })
+        elif path.startswith("/api/campaigns/") and path.endswith("/status") and method == "GET":
+            user = get_current_user(request)
+            if not user:
+                return json.dumps({"error": "Invalid authentication"}), 401, headers
+            campaign_id = path.split("/")[-2]
+            status = campaign_tracker.get_temp_campaign_status(campaign_id) if campaign_id.endswith(f"_{user.id}") else None
             if not status:
                 return json.dumps({"error": "Campaign not found"}), 404, headers
             return json.dumps(status), 200, headers
@@ -299,7 +807,7 @@ def email_api(request):
             if not user:
                 return json.dumps({"error": "Invalid authentication"}), 401, headers
             try:
-                response = supabase.table("email_templates").select("*").eq("user_id", user.id).execute()
+                response = get_supabase().table("email_templates").select("*").eq("user_id", user.id).execute()
                 templates = response.data if response.data else []
                 return json.dumps({"templates": templates}), 200, headers
             except Exception as e:
@@ -320,7 +828,7 @@ def email_api(request):
                     "body": data.get("body"),
                     "attachments": data.get("attachments", [])
                 }
-                response = supabase.table("email_templates").insert(template_data).execute()
+                response = get_supabase().table("email_templates").insert(template_data).execute()
                 if response.data:
                     return json.dumps(response.data[0]), 201, headers
                 else:
@@ -333,23 +841,16 @@ def email_api(request):
             if not user:
                 return json.dumps({"error": "Invalid authentication"}), 401, headers
             try:
-                templates_response = supabase.table("email_templates").select("id").eq("user_id", user.id).execute()
-                templates_count = len(templates_response.data) if templates_response.data else 0
-                
-                # Check if user has email settings
-                user_settings = get_user_email_settings(user.id)
-                has_email_settings = user_settings is not None
-                
-                total_campaigns = 0
-                total_emails_sent = 0
-                total_emails_failed = 0
+                # Totals come from user_campaign_totals, which a trigger keeps current (add-dashboard-stats.sql)
+                response = get_supabase().rpc("get_dashboard_stats", {"p_user_id": user.id}).execute()
+                stats = response.data or {}
                 stats = {
-                    "total_campaigns": total_campaigns,
-                    "total_emails_sent": total_emails_sent,
-                    "total_emails_failed": total_emails_failed,
-                    "recent_campaigns": [],
-                    "templates_count": templates_count,
-                    "has_email_settings": has_email_settings
+                    "total_campaigns": stats.get("total_campaigns", 0),
+                    "total_emails_sent": stats.get("total_emails_sent", 0),
+                    "total_emails_failed": stats.get("total_emails_failed", 0),
+                    "recent_campaigns": stats.get("recent_campaigns") or [],
+                    "templates_count": stats.get("templates_count", 0),
+                    "has_email_settings": stats.get("has_email_settings", False)
                 }
                 return json.dumps(stats), 200, headers
             except Exception as e:
@@ -0,0 +1,84 @@
+"""
+Message Builder - Assembles outgoing messages as bytes around attachments encoded once per campaign
+"""
+
+import base64
+import secrets
+import logging
+from email.message import Message
+from email.policy import compat32
+from typing import Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# Same header handling as Message.as_string(), but with the CRLF line endings SMTP expects
+SMTP_POLICY = compat32.clone(linesep="\r\n")
+CRLF = b"\r\n"
+
+
+class PreparedAttachments:
+    """Immutable, already base64-encoded MIME parts shared by every message of a campaign"""
+
+    __slots__ = ("blocks",)
+
+    def __init__(self, blocks: Iterable[bytes] = ()):
+        self.blocks = tuple(blocks)
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+
+def prepare_attachments(attachments: List[dict]) -> PreparedAttachments:
+    """Decode and encode each {filename, content} attachment once into a serialized MIME part"""
+    # Imported on first use to keep email.mime out of main's cold start
+    from email import encoders
+    from email.mime.base import MIMEBase
+
+    blocks = []
+    for attachment in attachments or []:
+        try:
+            file_content = base64.b64decode(attachment["content"])
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(file_content)
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', f'attachment; filename= {attachment["filename"]}')
+            blocks.append(part.as_bytes(policy=SMTP_POLICY))
+        except Exception as e:
+            logger.error(f"Failed to attach file {attachment.get('filename')}: {e}")
+    return PreparedAttachments(blocks)
+
+
+def _make_boundary(parts: List[bytes]) -> bytes:
+    while True:
+        boundary = ("=" * 15 + secrets.token_hex(10) + "==").encode("ascii")
+        if not any(boundary in part for part in parts):
+            return boundary
+
+
+def build_message(subject: str, sender: str, recipient: str, text: str, html: str,
+                  attachments: PreparedAttachments = PreparedAttachments()) -> bytes:
+    """Serialize a multipart/alternative message with the given bodies and prepared attachments"""
+    from email.mime.text import MIMEText
+
+    parts = [
+        MIMEText(text, "plain").as_bytes(policy=SMTP_POLICY),
+        MIMEText(html, "html").as_bytes(policy=SMTP_POLICY),
+    ]
+    boundary = _make_boundary(parts)
+
+    headers = Message()
+    headers["Content-Type"] = f'multipart/alternative; boundary="{boundary.decode("ascii")}"'
+    headers["MIME-Version"] = "1.0"
+    headers["Subject"] = subject
+    headers["From"] = sender
+    headers["To"] = recipient
+    # An empty string payload makes the generator emit only the header block
+    headers.set_payload("")
+
+    delimiter = CRLF + b"--" + boundary + CRLF
+    return b"".join([
+        headers.as_bytes(policy=SMTP_POLICY),
+        b"--", boundary, CRLF,
+        delimiter.join(parts + list(attachments.blocks)),
+        CRLF, b"--", boundary, b"--", CRLF,
+    ])
@@ -0,0 +1,207 @@
+"""
+Metrics - Low-overhead counters, gauges and histograms rendered in Prometheus text format
+"""
+
+import bisect
+import sys
+import threading
+import time
+import logging
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds; spans a cached lookup (sub-millisecond) up to a slow SMTP round trip
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(tuple(zip(self.labelnames, key)))} {value}")
+        return lines
+
+
+class Gauge:
+    """Value that goes up and down, or is computed by a callback at scrape time"""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Iterable[Tuple[dict, float]]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        if self.callback is None:
+            lines.append(f"{self.name} {self._value}")
+            return lines
+        try:
+            for labels, value in self.callback():
+                lines.append(f"{self.name}{_format_labels(tuple(labels.items()))} {value}")
+        except Exception as e:
+            logger.error(f"Metric callback for {self.name} failed: {e}")
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and three additions under a lock"""
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+template_render_seconds = registry.register(Histogram(
+    "emailer_template_render_seconds", "Time to render a compiled template for one contact"))
+mime_build_seconds = registry.register(Histogram(
+    "emailer_mime_build_seconds", "Time to assemble one message's MIME bytes"))
+smtp_send_seconds = registry.register(Histogram(
+    "emailer_smtp_send_seconds", "SMTP sendmail round trip for one message"))
+smtp_batch_seconds = registry.register(Histogram(
+    "emailer_smtp_batch_seconds", "SMTP transaction for one multi-recipient batch, envelope through final reply"))
+supabase_auth_seconds = registry.register(Histogram(
+    "emailer_supabase_auth_seconds", "Supabase auth.get_user call in get_current_user"))
+supabase_settings_seconds = registry.register(Histogram(
+    "emailer_supabase_settings_seconds", "Supabase email_settings query in get_user_email_settings"))
+emails_total = registry.register(Counter(
+    "emailer_emails_total", "Emails processed by outcome", labelnames=("outcome",)))
+smtp_active_connections = registry.register(Gauge(
+    "emailer_smtp_active_connections", "Open SMTP sessions across all campaigns"))
+send_queue_depth = registry.register(Gauge(
+    "emailer_send_queue_depth", "Contacts queued for pool workers but not yet sent"))
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads whose name starts with a prefix and tallies collapsed stacks
+
+    The output is in the collapsed format ("frame;frame;frame count") used by flame graph tools.
+    """
+
+    def __init__(self, thread_prefix: str, interval: float = 0.005, max_depth: int = 40):
+        self.thread_prefix = thread_prefix
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = _Tally()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SamplingProfiler":
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{self.thread_prefix}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            idents = {thread.ident for thread in threading.enumerate()
+                      if thread.name.startswith(self.thread_prefix)}
+            for ident, frame in sys._current_frames().items():
+                if ident not in idents:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
@@ -0,0 +1,249 @@
+"""
+Send Scheduler - Per-account rate limits and backoff for temporary SMTP errors
+"""
+
+import os
+import random
+import smtplib
+import threading
+import time
+import logging
+from datetime import date, datetime
+from typing import Dict, Optional, Tuple
+
+from supabase_store import SupabaseStore
+
+logger = logging.getLogger(__name__)
+
+# (messages per second, messages per day) for known providers; None means unlimited
+PROVIDER_LIMITS: Dict[str, Tuple[float, Optional[int]]] = {
+    "smtp.gmail.com": (10.0, 2000),
+    "smtp.office365.com": (0.5, 10000),
+    "smtp-mail.outlook.com": (0.5, 300),
+}
+DEFAULT_MESSAGES_PER_SECOND = float(os.getenv("SMTP_MESSAGES_PER_SECOND", "10"))
+DEFAULT_MESSAGES_PER_DAY = int(os.getenv("SMTP_MESSAGES_PER_DAY", "0")) or None
+
+# Messages claimed at a time from the shared daily counter; a cold start forfeits at most one unused lease
+QUOTA_LEASE_SIZE = int(os.getenv("SMTP_DAILY_QUOTA_LEASE", "20"))
+
+MAX_TRANSIENT_RETRIES = int(os.getenv("SMTP_MAX_TRANSIENT_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+
+class DailyQuotaExceeded(Exception):
+    """Raised when an account has used its messages-per-day budget"""
+
+
+def transient_smtp_code(error: Exception) -> Optional[int]:
+    """Return the 4xx reply code if the error is a temporary SMTP failure worth retrying"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        if codes and all(400 <= code < 500 for code in codes):
+            return codes[0]
+        return None
+    if isinstance(error, smtplib.SMTPResponseException) and 400 <= error.smtp_code < 500:
+        return error.smtp_code
+    return None
+
+
+def smtp_reply(error: Exception) -> str:
+    """Render an SMTP error as "<code> <text>" for delivery records; other errors fall back to str()"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        code, message = next(iter(error.recipients.values()))
+    elif isinstance(error, smtplib.SMTPResponseException):
+        code, message = error.smtp_code, error.smtp_error
+    else:
+        # aiosmtplib errors carry code/message, and refusals a list of per-recipient errors
+        recipients = getattr(error, "recipients", None)
+        source = recipients[0] if recipients else error
+        code, message = getattr(source, "code", None), getattr(source, "message", None)
+        if not isinstance(code, int):
+            return str(error)
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", "replace")
+    return f"{code} {message}"
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter for the given retry attempt (1-based)"""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+    """Thread-safe token bucket; reserve() hands out a slot and says how long to wait for it"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def try_acquire(self) -> float:
+        """Take a token only if one is available now; otherwise return the seconds until there is one"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class SupabaseQuotaStore(SupabaseStore):
+    """Counts each account's messages per UTC day in account_daily_usage, shared by every instance"""
+
+    def claim(self, account_key: str, day: date, count: int, limit: int) -> int:
+        """Take up to count more messages of the day's limit; returns how many were granted"""
+        response = self.client.rpc("claim_daily_quota", {
+            "p_account_key": account_key, "p_day": day.isoformat(), "p_count": count, "p_limit": limit,
+        }).execute()
+        return int(response.data or 0)
+
+    def used(self, account_key: str, day: date) -> int:
+        response = self.client.table("account_daily_usage").select("sent").eq(
+            "account_key", account_key
+        ).eq("day", day.isoformat()).limit(1).execute()
+        return int(response.data[0]["sent"]) if response.data else 0
+
+
+class AccountScheduler:
+    """Messages-per-second and messages-per-day budgets for one sending account
+
+    The rate limit is enforced per process. The daily budget is counted in this process only
+    unless a quota store is given; with one, messages are claimed from the shared counter in
+    leases of QUOTA_LEASE_SIZE, so the limit holds across instances and cold starts.
+    """
+
+    def __init__(self, messages_per_second: float, messages_per_day: Optional[int], key: str = None,
+                 store: SupabaseQuotaStore = None):
+        self.bucket = TokenBucket(messages_per_second)
+        self.messages_per_day = messages_per_day
+        self.key = key
+        self.store = store
+        self._day = datetime.utcnow().date()
+        self._sent_today = 0
+        # Messages claimed from the store for today and not sent yet, and whether it has none left to give
+        self._leased = 0
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    def configure(self, messages_per_second: float, messages_per_day: Optional[int]) -> None:
+        if messages_per_second != self.bucket.rate:
+            self.bucket = TokenBucket(messages_per_second)
+        if messages_per_day != self.messages_per_day:
+            self._exhausted = False
+        self.messages_per_day = messages_per_day
+
+    def remaining_today(self) -> Optional[int]:
+        with self._lock:
+            self._roll_day()
+            if not self.messages_per_day:
+                return None
+            used = self._sent_today
+            if self.store is not None:
+                try:
+                    # What this process has leased but not sent is still available to it
+                    used = self.store.used(self.key, self._day) - self._leased
+                except Exception as e:
+                    logger.error(f"Could not read daily usage of account {self.key}: {e}")
+            return max(0, self.messages_per_day - used)
+
+    def needs_lease(self) -> bool:
+        """True when the next consume_daily() has to claim budget from the store, a blocking call"""
+        return bool(self.store is not None and self.messages_per_day
+                    and (self._leased <= 0 and not self._exhausted or self._day != datetime.utcnow().date()))
+
+    def consume_daily(self) -> None:
+        """Count one message against today's budget"""
+        with self._lock:
+            self._roll_day()
+            if self.messages_per_day and self.store is not None:
+                if self._leased <= 0 and not self._exhausted:
+                    self._leased = self._claim()
+                    self._exhausted = self._leased <= 0
+                if self._leased <= 0:
+                    raise DailyQuotaExceeded(f"Daily limit of {self.messages_per_day} messages reached")
+                self._leased -= 1
+            elif self.messages_per_day and self._sent_today >= self.messages_per_day:
+                raise DailyQuotaExceeded(f"Daily limit of {self.messages_per_day} messages reached")
+            self._sent_today += 1
+
+    def _claim(self) -> int:
+        # Called with the lock held; takes the next lease of today's budget from the shared counter
+        try:
+            return self.store.claim(self.key, self._day, QUOTA_LEASE_SIZE, self.messages_per_day)
+        except Exception as e:
+            logger.error(f"Could not claim daily quota for account {self.key}, counting in this process: {e}")
+            return max(0, min(QUOTA_LEASE_SIZE, self.messages_per_day - self._sent_today))
+
+    def reserve(self) -> float:
+        """Take a rate-limit slot; returns the seconds to wait before using it"""
+        return self.bucket.reserve()
+
+    def try_reserve(self) -> float:
+        """Take a rate-limit slot if one is free now; otherwise return the seconds until one is, taking nothing"""
+        return self.bucket.try_acquire()
+
+    def wait_for_slot(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _roll_day(self) -> None:
+        today = datetime.utcnow().date()
+        if today != self._day:
+            self._day = today
+            self._sent_today = 0
+            self._leased = 0
+            self._exhausted = False
+
+
+def account_limits(user_settings: dict) -> Tuple[float, Optional[int]]:
+    """Resolve the rate limits for an email_settings row, falling back to provider defaults"""
+    per_second, per_day = PROVIDER_LIMITS.get(
+        (user_settings.get("email_host") or "").lower(),
+        (DEFAULT_MESSAGES_PER_SECOND, DEFAULT_MESSAGES_PER_DAY),
+    )
+    if user_settings.get("max_messages_per_second"):
+        per_second = float(user_settings["max_messages_per_second"])
+    if user_settings.get("max_messages_per_day"):
+        per_day = int(user_settings["max_messages_per_day"])
+    return per_second, per_day
+
+
+_schedulers: Dict[str, AccountScheduler] = {}
+_schedulers_lock = threading.Lock()
+_quota_store: Optional[SupabaseQuotaStore] = None
+
+
+def attach_quota_store(store: SupabaseQuotaStore) -> None:
+    """Share daily budgets through the given store for schedulers created from now on"""
+    global _quota_store
+    _quota_store = store
+
+
+def get_account_scheduler(user_settings: dict) -> AccountScheduler:
+    """Return the process-wide scheduler for an account, shared by all of its campaigns"""
+    key = str(user_settings.get("id") or f"{user_settings.get('email_user')}@{user_settings.get('email_host')}")
+    per_second, per_day = account_limits(user_settings)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = _schedulers[key] = AccountScheduler(per_second, per_day, key=key, store=_quota_store)
+        else:
+            scheduler.configure(per_second, per_day)
+        return scheduler
@@ -0,0 +1,288 @@
+"""
+SMTP Connection Pool - Sends a campaign over several authenticated SMTP sessions in parallel
+"""
+
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+import logging
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from metrics import send_queue_depth, smtp_active_connections
+from send_scheduler import (AccountScheduler, DailyQuotaExceeded, MAX_TRANSIENT_RETRIES, backoff_delay,
+                            smtp_reply, transient_smtp_code)
+
+logger = logging.getLogger(__name__)
+
+# Pool defaults, overridable per account through the email_settings row
+DEFAULT_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+DEFAULT_MAX_MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+DEFAULT_SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+DEFAULT_RECONNECT_ATTEMPTS = 2
+# How long a session opened by warm_connection() waits to be claimed by a campaign
+WARM_CONNECTION_TTL = float(os.getenv("SMTP_WARM_CONNECTION_TTL", "60"))
+
+# Errors that mean the session is unusable and has to be re-established
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+_STOP = object()
+
+
+class PooledSMTPConnection:
+    """A single authenticated SMTP session that reconnects on demand and is recycled after max_messages"""
+
+    def __init__(self, user_settings: dict, max_messages: int = DEFAULT_MAX_MESSAGES_PER_CONNECTION):
+        self.user_settings = user_settings
+        self.max_messages = max_messages
+        self.server: Optional[smtplib.SMTP] = None
+        self.messages_sent = 0
+
+    def connect(self) -> smtplib.SMTP:
+        """Open, secure and authenticate a new SMTP session"""
+        self.close()
+        context = ssl.create_default_context()
+        server = smtplib.SMTP(self.user_settings['email_host'], self.user_settings['email_port'],
+                              timeout=DEFAULT_SMTP_TIMEOUT)
+        try:
+            if self.user_settings.get("smtp_use_tls", True):
+                server.starttls(context=context)
+            if self.user_settings.get('email_password'):
+                server.login(self.user_settings['email_user'], self.user_settings['email_password'])
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.messages_sent = 0
+        smtp_active_connections.inc()
+        return server
+
+    def get(self) -> smtplib.SMTP:
+        """Return a live session, recycling it once it has carried max_messages"""
+        if self.server is None:
+            return self.connect()
+        if self.max_messages and self.messages_sent >= self.max_messages:
+            logger.debug(f"Recycling SMTP connection after {self.messages_sent} messages")
+            return self.connect()
+        return self.server
+
+    def mark_used(self) -> None:
+        self.messages_sent += 1
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+        self.server = None
+        smtp_active_connections.dec()
+
+
+def _account_key(user_settings: dict) -> tuple:
+    return user_settings['email_host'], user_settings['email_port'], user_settings['email_user']
+
+
+_warm_connections: Dict[tuple, Tuple[PooledSMTPConnection, float]] = {}
+_warm_lock = threading.Lock()
+
+
+def warm_connection(user_settings: dict) -> None:
+    """Open an authenticated session ahead of an expected send and park it for the next pool to claim
+
+    A session nobody claims is closed after WARM_CONNECTION_TTL, so it does not hold a slot on
+    the server or stay counted in smtp_active_connections.
+    """
+    key = _account_key(user_settings)
+    with _warm_lock:
+        if key in _warm_connections:
+            return
+
+    connection = PooledSMTPConnection(user_settings)
+    connection.connect()
+    with _warm_lock:
+        previous = _warm_connections.pop(key, None)
+        _warm_connections[key] = (connection, time.monotonic())
+    if previous is not None:
+        previous[0].close()
+    expiry = threading.Timer(WARM_CONNECTION_TTL, _expire_warm_connection, args=(key, connection))
+    expiry.name = "smtp-warm-expiry"
+    expiry.daemon = True
+    expiry.start()
+    logger.info(f"Warmed SMTP connection to {key[0]}:{key[1]} for {key[2]}")
+
+
+def _expire_warm_connection(key: tuple, connection: PooledSMTPConnection) -> None:
+    with _warm_lock:
+        entry = _warm_connections.get(key)
+        if entry is None or entry[0] is not connection:
+            # Claimed by a pool or replaced since it was parked
+            return
+        del _warm_connections[key]
+    connection.close()
+    logger.debug(f"Closed unclaimed warm SMTP connection to {key[0]}:{key[1]} for {key[2]}")
+
+
+def claim_warm_connection(user_settings: dict, max_messages: int) -> Optional[PooledSMTPConnection]:
+    """Take the parked session for this account, if one is still fresh"""
+    with _warm_lock:
+        entry = _warm_connections.pop(_account_key(user_settings), None)
+    if entry is None:
+        return None
+    connection, opened_at = entry
+    if time.monotonic() - opened_at > WARM_CONNECTION_TTL:
+        connection.close()
+        return None
+    connection.max_messages = max_messages
+    return connection
+
+
+class SMTPConnectionPool:
+    """Feeds contacts from a shared queue to worker threads, each owning one SMTP connection"""
+
+    def __init__(self, user_settings: dict, size: int = None, max_messages_per_connection: int = None,
+                 reconnect_attempts: int = DEFAULT_RECONNECT_ATTEMPTS, scheduler: AccountScheduler = None,
+                 transient_retries: int = MAX_TRANSIENT_RETRIES, name: str = "smtp-pool"):
+        self.user_settings = user_settings
+        self.name = name
+        self.scheduler = scheduler
+        self.transient_retries = transient_retries
+        self.size = max(1, int(size or user_settings.get("smtp_pool_size") or DEFAULT_POOL_SIZE))
+        self.max_messages = int(max_messages_per_connection
+                                or user_settings.get("smtp_max_messages_per_connection")
+                                or DEFAULT_MAX_MESSAGES_PER_CONNECTION)
+        self.reconnect_attempts = reconnect_attempts
+        self._lock = threading.Lock()
+        self.sent_count = 0
+        self.failed_count = 0
+        # Set once the account's daily budget runs out; contacts drawn after that are kept in unsent
+        self.quota_error: Optional[DailyQuotaExceeded] = None
+        self.unsent = []
+
+    def send_all(self, contacts: Iterable[Tuple[int, dict]],
+                 send_fn: Callable[[dict, smtplib.SMTP], bool],
+                 on_result: Callable[[int, dict, bool, Optional[str]], None] = None) -> Tuple[int, int]:
+        """Send every (index, contact) pair with send_fn and return the aggregate (sent, failed) counts.
+
+        on_result is called from the worker threads with the contact's outcome and, when known,
+        the SMTP response or error that decided it.
+
+        The first connection is opened on the calling thread so that authentication errors
+        propagate to the caller instead of failing every contact individually, unless a
+        session opened by warm_connection() is waiting for this account.
+
+        Raises DailyQuotaExceeded once the account's daily budget runs out, after the workers
+        stop; the contacts that were not sent are left out of the counts and kept in unsent.
+        """
+        first_connection = claim_warm_connection(self.user_settings, self.max_messages)
+        if first_connection is None:
+            first_connection = PooledSMTPConnection(self.user_settings, self.max_messages)
+            first_connection.connect()
+
+        work: "queue.Queue" = queue.Queue(maxsize=self.size * 4)
+        workers = []
+        for n in range(self.size):
+            connection = first_connection if n == 0 else PooledSMTPConnection(self.user_settings, self.max_messages)
+            worker = threading.Thread(target=self._worker, args=(connection, work, send_fn, on_result),
+                                      name=f"{self.name}-worker-{n}", daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        try:
+            for item in contacts:
+                if self.quota_error is not None:
+                    # Stop drawing contacts so a resume can send the rest
+                    self.unsent.append(item)
+                    break
+                send_queue_depth.inc()
+                work.put(item)
+        finally:
+            for _ in workers:
+                work.put(_STOP)
+            for worker in workers:
+                worker.join()
+
+        if self.quota_error is not None:
+            raise self.quota_error
+        return self.sent_count, self.failed_count
+
+    def _worker(self, connection: PooledSMTPConnection, work: "queue.Queue", send_fn, on_result) -> None:
+        try:
+            while True:
+                item = work.get()
+                if item is _STOP:
+                    break
+                send_queue_depth.dec()
+                index, contact = item
+                if self.quota_error is not None:
+                    with self._lock:
+                        self.unsent.append(item)
+                    continue
+                try:
+                    success, response = self._send_with_reconnect(connection, contact, send_fn)
+                except DailyQuotaExceeded as e:
+                    with self._lock:
+                        self.unsent.append(item)
+                        if self.quota_error is None:
+                            self.quota_error = e
+                            logger.warning(f"{self.name} stopped drawing contacts: {e}; the rest are left for a resume")
+                    continue
+                with self._lock:
+                    if success:
+                        self.sent_count += 1
+                    else:
+                        self.failed_count += 1
+                if on_result:
+                    try:
+                        on_result(index, contact, success, response)
+                    except Exception as e:
+                        logger.error(f"Result callback failed for {contact.get('email')}: {e}")
+        finally:
+            connection.close()
+
+    def _send_with_reconnect(self, connection: PooledSMTPConnection, contact: dict,
+                             send_fn) -> Tuple[bool, Optional[str]]:
+        if self.scheduler:
+            # Raises DailyQuotaExceeded for the worker to stop on
+            self.scheduler.consume_daily()
+
+        reconnects = 0
+        transient_attempts = 0
+        while True:
+            if self.scheduler:
+                self.scheduler.wait_for_slot()
+            try:
+                server = connection.get()
+                connection.mark_used()
+                success = send_fn(contact, server)
+                return success, "250 OK" if success else None
+            except CONNECTION_ERRORS as e:
+                reconnects += 1
+                logger.warning(f"SMTP connection lost while sending to {contact.get('email')} "
+                               f"(attempt {reconnects}): {e}")
+                connection.close()
+                if reconnects > self.reconnect_attempts:
+                    return False, str(e)
+            except Exception as e:
+                code = transient_smtp_code(e)
+                if code is None:
+                    logger.error(f"Error sending to {contact.get('email')}: {e}")
+                    return False, smtp_reply(e)
+                transient_attempts += 1
+                if transient_attempts > self.transient_retries:
+                    logger.error(f"Giving up on {contact.get('email')} after {self.transient_retries} "
+                                 f"temporary failures: {e}")
+                    return False, smtp_reply(e)
+                if code == 421:
+                    # The server is closing the session; start a fresh one for the retry
+                    connection.close()
+                delay = backoff_delay(transient_attempts)
+                logger.info(f"Temporary SMTP error {code} for {contact.get('email')}, "
+                            f"retrying in {delay:.1f}s")
+                time.sleep(delay)
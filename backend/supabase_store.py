@@ -0,0 +1,15 @@
+"""
+Supabase Store - Base class for the stores that persist to a Supabase table
+"""
+
+
+class SupabaseStore:
+    """Holds the Supabase client for a store, built on first use when given as a function"""
+
+    def __init__(self, client):
+        # A supabase Client, or a function returning one so the client is only built when first needed
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client() if callable(self._client) else self._client
@@ -0,0 +1,122 @@
+"""
+Suppression - Per-user index of recipients who must not be mailed again (bounces, complaints, unsubscribes)
+"""
+
+import os
+import re
+import logging
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from contact_stream import email_digest
+from delivery_log import digest_hex
+from supabase_store import SupabaseStore
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+SUPPRESSION_REASONS = ("bounce", "complaint", "unsubscribe", "manual")
+PAGE_SIZE = 1000
+
+# Permanent failures that say the mailbox itself is bad; policy rejections (5.7.x) are not bounces
+HARD_BOUNCE_CODES = (550, 551, 553)
+_ENHANCED_STATUS = re.compile(r"^\d{3}[ -](\d\.\d{1,3}\.\d{1,3})\b")
+
+suppression_cache = TTLCache("suppressions", maxsize=int(os.getenv("SUPPRESSION_CACHE_SIZE", "1024")),
+                             ttl=float(os.getenv("SUPPRESSION_CACHE_TTL", "300")))
+
+
+def is_hard_bounce(response: Optional[str]) -> bool:
+    """True for an SMTP reply ("550 5.1.1 ...") that rejects the recipient address itself"""
+    if not response or not response[:3].isdigit():
+        return False
+    enhanced = _ENHANCED_STATUS.match(response)
+    if enhanced:
+        return enhanced.group(1).startswith("5.1.")
+    return int(response[:3]) in HARD_BOUNCE_CODES
+
+
+class SupabaseSuppressionStore(SupabaseStore):
+    """Stores suppressed recipients in the email_suppressions table"""
+
+    def entries(self, user_id: str) -> List[Tuple[str, int]]:
+        """(email, digest) for every address the user has suppressed"""
+        entries = []
+        start = 0
+        while True:
+            response = self.client.table("email_suppressions").select("email, email_hash").eq(
+                "user_id", user_id
+            ).order("id").range(start, start + PAGE_SIZE - 1).execute()
+            rows = response.data or []
+            entries.extend((row["email"], int(row["email_hash"], 16)) for row in rows)
+            if len(rows) < PAGE_SIZE:
+                return entries
+            start += PAGE_SIZE
+
+    def add(self, user_id: str, emails: Iterable[str], reason: str, tracker_id: str = None) -> int:
+        rows = {}
+        for email in emails:
+            email = email.strip().lower()
+            rows[email] = {"user_id": user_id, "email": email, "email_hash": digest_hex(email),
+                           "reason": reason, "tracker_id": tracker_id}
+        if rows:
+            self.client.table("email_suppressions").upsert(list(rows.values()),
+                                                           on_conflict="user_id,email_hash").execute()
+        return len(rows)
+
+    def remove(self, user_id: str, emails: Iterable[str]) -> None:
+        digests = [digest_hex(email.strip()) for email in emails]
+        if digests:
+            self.client.table("email_suppressions").delete().eq("user_id", user_id).in_(
+                "email_hash", digests
+            ).execute()
+
+
+class SuppressionIndex:
+    """Two-level membership test for one user's suppressed addresses
+
+    The first level is a set of Python's built-in string hash of each lowercased address, which is far
+    cheaper to compute per contact than a cryptographic digest. Hits are confirmed against the set of
+    stored 64-bit blake2b digests, so a hash collision cannot suppress a contact by mistake.
+    """
+
+    __slots__ = ("_fast", "_digests")
+
+    def __init__(self, entries: Iterable[Tuple[str, int]] = ()):
+        self._fast = set()
+        self._digests = set()
+        for email, digest in entries:
+            self._fast.add(hash(email.lower()))
+            self._digests.add(digest)
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def __contains__(self, email: str) -> bool:
+        return hash(email.lower()) in self._fast and email_digest(email) in self._digests
+
+    def screen_all(self, work: List[Tuple[int, dict]]) -> List[Tuple[int, dict]]:
+        """Drop suppressed contacts from an in-memory list of (index, contact) pairs in one pass"""
+        fast, digests = self._fast, self._digests
+        # Keep the existing pair objects: building new tuples here costs more than the lookups
+        return [
+            pair for pair in work
+            if hash(pair[1]["email"].lower()) not in fast or email_digest(pair[1]["email"]) not in digests
+        ]
+
+    def screen(self, work: Iterable[Tuple[int, dict]], on_suppressed: Callable[[], None]) -> Iterator[Tuple[int, dict]]:
+        """Lazily drop suppressed contacts from a stream, calling on_suppressed for each one"""
+        for index, contact in work:
+            if contact["email"] in self:
+                on_suppressed()
+                continue
+            yield index, contact
+
+
+def get_suppression_index(store: SupabaseSuppressionStore, user_id: str) -> SuppressionIndex:
+    """The user's index, loaded from the store at most once per cache TTL"""
+    index = suppression_cache.get(user_id)
+    if index is None:
+        index = SuppressionIndex(store.entries(user_id))
+        suppression_cache.set(user_id, index)
+        logger.info(f"Loaded {len(index)} suppressed recipients for user {user_id}")
+    return index
@@ -0,0 +1,117 @@
+"""
+Template Engine - Compiles an email template once per campaign and renders it per contact
+"""
+
+import re
+import logging
+from html import escape as html_escape
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_PATTERN = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+# Placeholder names used by the frontend that differ from the contact column name
+PLACEHOLDER_ALIASES = {
+    "jobTitle": "job_title",
+}
+
+# Columns every contact must have; other placeholders are left untouched when the column is empty
+REQUIRED_FIELDS = ("name", "email")
+
+# Alphanumeric marker that survives markdown rendering unchanged
+_MARKER = "EMAILERSLOT{}X"
+_MARKER_PATTERN = re.compile(r"EMAILERSLOT(\d+)X")
+
+
+class CompiledTemplate:
+    """A template split into literal segments and placeholder slots; escape_html escapes values put into HTML"""
+
+    __slots__ = ("literals", "slots", "escape_html")
+
+    def __init__(self, literals: List[str], slots: List[Tuple[str, str]], escape_html: bool = False):
+        # literals always has one more entry than slots; each slot is (column, original placeholder text)
+        self.literals = tuple(literals)
+        self.slots = tuple(slots)
+        self.escape_html = escape_html
+
+    @property
+    def is_personalized(self) -> bool:
+        return bool(self.slots)
+
+    def render(self, contact: Dict) -> str:
+        literals = self.literals
+        escape_html = self.escape_html
+        parts = [literals[0]]
+        for i, (column, placeholder) in enumerate(self.slots):
+            if column in REQUIRED_FIELDS:
+                value = contact[column]
+            else:
+                value = contact.get(column)
+                if not value:
+                    parts.append(placeholder)
+                    parts.append(literals[i + 1])
+                    continue
+            # CSV values are text; in the HTML part "AT&T" or "<b>" must not become markup
+            parts.append(html_escape(str(value), quote=False) if escape_html else str(value))
+            parts.append(literals[i + 1])
+        return "".join(parts)
+
+
+class CompiledEmailTemplate:
+    """Subject plus plain text and HTML bodies, compiled once per campaign"""
+
+    __slots__ = ("subject", "text", "html")
+
+    def __init__(self, subject: str, text: CompiledTemplate, html: CompiledTemplate):
+        self.subject = subject
+        self.text = text
+        self.html = html
+
+    @property
+    def is_personalized(self) -> bool:
+        return self.text.is_personalized or self.html.is_personalized
+
+
+def compile_template(body: str, escape_html: bool = False) -> CompiledTemplate:
+    """Split a body on {placeholder} markers"""
+    literals = []
+    slots = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(body):
+        name = match.group(1)
+        literals.append(body[position:match.start()])
+        slots.append((PLACEHOLDER_ALIASES.get(name, name), match.group(0)))
+        position = match.end()
+    literals.append(body[position:])
+    return CompiledTemplate(literals, slots, escape_html)
+
+
+def preload() -> None:
+    """Import the markdown renderer ahead of the first campaign that needs it"""
+    import markdown  # noqa: F401
+
+
+def _compile_markdown(body: str) -> CompiledTemplate:
+    """Render markdown to HTML once, keeping the placeholder slots intact"""
+    import markdown
+    placeholders = []
+
+    def mark(match):
+        placeholders.append(match.group(0))
+        return _MARKER.format(len(placeholders) - 1)
+
+    marked = PLACEHOLDER_PATTERN.sub(mark, body)
+    html = markdown.markdown(marked, extensions=['extra'])
+    return compile_template(_MARKER_PATTERN.sub(lambda m: placeholders[int(m.group(1))], html), escape_html=True)
+
+
+def compile_email_template(template: Dict) -> CompiledEmailTemplate:
+    """Compile a template dict ({subject, body}) for repeated rendering"""
+    body = template["body"]
+    text = compile_template(body)
+    if body.startswith("<") and body.endswith(">"):
+        html = compile_template(body, escape_html=True)
+    else:
+        html = _compile_markdown(body)
+    return CompiledEmailTemplate(template["subject"], text, html)
@@ -0,0 +1,46 @@
+"""
+Shared fixtures for the sending tests - a local SMTP sink and sending-account settings pointing at it
+"""
+
+import os
+import socket
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "benchmarks"))
+
+from smtp_sink import SMTPSink  # noqa: E402
+
+
+@pytest.fixture
+def sink():
+    server = SMTPSink().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def closed_port():
+    """A local port with nothing listening on it, so connecting is refused straight away"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def account(port: int, user: str = "sender@example.com", **overrides) -> dict:
+    """An email_settings row for a plain-text local SMTP server"""
+    settings = {
+        "id": user,
+        "email_host": "127.0.0.1",
+        "email_port": port,
+        "email_user": user,
+        "email_password": "secret",
+        "email_display_name": "Sender",
+        "smtp_use_tls": False,
+    }
+    settings.update(overrides)
+    return settings
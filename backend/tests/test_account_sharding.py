@@ -0,0 +1,114 @@
+"""
+Account Sharding tests - weighted splitting and failover of ShardedPoolSender against the local sink
+"""
+
+import threading
+from collections import Counter
+
+import pytest
+
+from account_sharding import AccountSelector, ShardedPoolSender
+from conftest import account
+from send_scheduler import AccountScheduler, DailyQuotaExceeded
+
+MESSAGE = b"Subject: test\r\n\r\nhello\r\n"
+
+
+def contacts(count: int):
+    return ((index, {"email": f"rcpt{index}@example.org"}) for index in range(count))
+
+
+def counting_send_fn_for(counts: Counter, lock: threading.Lock):
+    def send_fn_for(settings):
+        def send(contact, server):
+            server.sendmail(settings["email_user"], [contact["email"]], MESSAGE)
+            with lock:
+                counts[settings["email_user"]] += 1
+            return True
+        return send
+    return send_fn_for
+
+
+def schedulers(count: int, per_day: int = None):
+    return [AccountScheduler(100000, per_day) for _ in range(count)]
+
+
+def test_selector_follows_weights_and_skips_paused_accounts():
+    selector = AccountSelector([3, 1, 0], [None, None, None])
+    picks = Counter()
+    for _ in range(400):
+        account_index = selector.candidates([True, True, True])[0]
+        selector.assign(account_index)
+        picks[account_index] += 1
+    assert picks == {0: 300, 1: 100}
+
+
+def test_selector_skips_accounts_out_of_budget():
+    selector = AccountSelector([1, 1], [2, None])
+    picks = Counter()
+    for _ in range(10):
+        account_index = selector.candidates([True, True])[0]
+        selector.assign(account_index)
+        picks[account_index] += 1
+    assert picks == {0: 2, 1: 8}
+
+
+def test_sends_every_contact_split_by_weight(sink):
+    accounts = [account(sink.port, "a@example.com", weight=3), account(sink.port, "b@example.com", weight=1)]
+    counts, lock = Counter(), threading.Lock()
+    sender = ShardedPoolSender(accounts, schedulers(2), name="temp_test_user")
+
+    sent, failed = sender.send_all(contacts(400), counting_send_fn_for(counts, lock))
+
+    assert (sent, failed) == (400, 0)
+    assert sink.stats.messages == 400
+    # The preferred account's queue can be full for a moment, so the split is close to but not exactly 3:1
+    assert 260 <= counts["a@example.com"] <= 340
+
+
+def test_resends_through_other_accounts_when_one_cannot_connect(sink, closed_port):
+    accounts = [account(sink.port, "live@example.com"), account(closed_port, "dead@example.com")]
+    counts, lock = Counter(), threading.Lock()
+    results = []
+    sender = ShardedPoolSender(accounts, schedulers(2), name="temp_test_user")
+
+    sent, failed = sender.send_all(contacts(200), counting_send_fn_for(counts, lock),
+                                   lambda index, contact, success, response: results.append(index))
+
+    assert (sent, failed) == (200, 0)
+    assert counts == {"live@example.com": 200}
+    assert sorted(results) == list(range(200))
+
+
+def test_raises_when_no_account_can_connect(closed_port):
+    accounts = [account(closed_port, "a@example.com"), account(closed_port, "b@example.com")]
+    sender = ShardedPoolSender(accounts, schedulers(2), name="temp_test_user")
+
+    with pytest.raises(OSError):
+        sender.send_all(contacts(10), counting_send_fn_for(Counter(), threading.Lock()))
+
+
+def test_account_out_of_daily_budget_hands_its_share_to_the_others(sink):
+    accounts = [account(sink.port, "small@example.com"), account(sink.port, "large@example.com")]
+    counts, lock = Counter(), threading.Lock()
+    sender = ShardedPoolSender(accounts, [AccountScheduler(100000, 10), AccountScheduler(100000, None)],
+                               name="temp_test_user")
+
+    sent, failed = sender.send_all(contacts(100), counting_send_fn_for(counts, lock))
+
+    assert (sent, failed) == (100, 0)
+    assert counts["small@example.com"] <= 10
+
+
+def test_stops_drawing_contacts_when_every_account_is_out_of_daily_budget(sink):
+    accounts = [account(sink.port, "a@example.com"), account(sink.port, "b@example.com")]
+    results = []
+    sender = ShardedPoolSender(accounts, schedulers(2, per_day=10), name="temp_test_user")
+
+    with pytest.raises(DailyQuotaExceeded):
+        sender.send_all(contacts(100), counting_send_fn_for(Counter(), threading.Lock()),
+                        lambda index, contact, success, response: results.append(success))
+
+    # The rest are left unsent for a resume rather than reported as failures
+    assert results == [True] * 20
+    assert sink.stats.messages == 20
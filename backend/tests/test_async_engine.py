@@ -0,0 +1,97 @@
+"""
+Async Engine tests - session reuse, fairness between users and failure handling against the local sink
+"""
+
+import threading
+import time
+
+from async_engine import AsyncCampaign, AsyncSMTPEngine
+from conftest import account
+from send_scheduler import AccountScheduler, DailyQuotaExceeded
+
+MESSAGE = b"Subject: test\r\n\r\nhello\r\n"
+
+
+class Campaigns:
+    """Submits campaigns to an engine and records when each one finishes"""
+
+    def __init__(self, engine: AsyncSMTPEngine):
+        self.engine = engine
+        self.started = time.perf_counter()
+        self.finished = {}
+        self.results = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def submit(self, name: str, settings: dict, count: int, rate: float = 100000, user: str = None,
+               per_day: int = None) -> None:
+        contacts = ((index, {"email": f"rcpt{index}@example.org"}) for index in range(count))
+        self.results[name] = []
+
+        def on_result(index, contact, success, response):
+            self.results[name].append(success)
+
+        def on_finish(sent, failed, error=None):
+            with self._done:
+                self.finished[name] = (sent, failed, error, time.perf_counter() - self.started)
+                self._done.notify_all()
+
+        self.engine.submit(AsyncCampaign(name, user or name, settings, contacts, lambda contact: MESSAGE,
+                                         on_result, on_finish, AccountScheduler(rate, per_day)))
+
+    def wait(self, *names: str, timeout: float = 30) -> dict:
+        with self._done:
+            assert self._done.wait_for(lambda: all(name in self.finished for name in names), timeout)
+            return {name: self.finished[name] for name in names}
+
+
+def test_concurrent_campaigns_reuse_sessions(sink):
+    campaigns = Campaigns(AsyncSMTPEngine(max_sessions=4))
+    names = [f"campaign{n}" for n in range(8)]
+    for n, name in enumerate(names):
+        campaigns.submit(name, account(sink.port, f"user{n}@example.com"), 200)
+
+    finished = campaigns.wait(*names)
+
+    assert all(sent == 200 and failed == 0 for sent, failed, _, _ in finished.values())
+    assert sink.stats.messages == 1600
+    # A session per message would be 1600 connections; workers stay on a campaign while it has work
+    assert sink.stats.connections <= 64
+
+
+def test_rate_limited_campaign_does_not_hold_up_other_users(sink):
+    campaigns = Campaigns(AsyncSMTPEngine(max_sessions=4))
+    campaigns.submit("slow", account(sink.port, "slow@example.com"), 13, rate=4)
+    campaigns.submit("fast", account(sink.port, "fast@example.com"), 200)
+
+    fast = campaigns.wait("fast")["fast"]
+    slow = campaigns.wait("slow")["slow"]
+
+    assert fast[:2] == (200, 0) and slow[:2] == (13, 0)
+    # Past its first four tokens the slow account sends four per second, about 2.25s in all; waiting
+    # for its rate limit must not keep the other user's campaign off the sessions
+    assert fast[3] < 1.0 < 2.0 < slow[3]
+
+
+def test_campaign_that_cannot_connect_fails_without_stalling_others(sink, closed_port):
+    campaigns = Campaigns(AsyncSMTPEngine(max_sessions=4))
+    campaigns.submit("dead", account(closed_port, "dead@example.com"), 100)
+    campaigns.submit("live", account(sink.port, "live@example.com"), 100)
+
+    finished = campaigns.wait("dead", "live")
+
+    assert finished["live"][:2] == (100, 0)
+    sent, failed, error, _ = finished["dead"]
+    assert sent == 0 and error is not None
+
+
+def test_campaign_stops_drawing_contacts_when_the_daily_budget_runs_out(sink):
+    campaigns = Campaigns(AsyncSMTPEngine(max_sessions=4))
+    campaigns.submit("capped", account(sink.port, "capped@example.com"), 100, per_day=10)
+
+    sent, failed, error, _ = campaigns.wait("capped")["capped"]
+
+    assert (sent, failed) == (10, 0) and isinstance(error, DailyQuotaExceeded)
+    # The other 90 are left unsent for a resume rather than reported as failures
+    assert campaigns.results["capped"] == [True] * 10
+    assert sink.stats.messages == 10
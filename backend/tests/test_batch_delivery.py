@@ -0,0 +1,135 @@
+"""
+Batch Delivery tests - pipelined multi-recipient transactions and BatchSender against the local sink
+"""
+
+import smtplib
+
+import pytest
+
+import batch_delivery
+from batch_delivery import BatchSender, check_direct_mx_sender, prepare_data, send_batch
+from conftest import account
+
+MESSAGE = b"Subject: test\r\n\r\n.leading dot\r\nhello\r\n"
+
+
+class CountingSMTP(smtplib.SMTP):
+    """Counts writes to the socket, one per command unless commands are pipelined"""
+
+    writes = 0
+
+    def send(self, s):
+        self.writes += 1
+        super().send(s)
+
+
+def connect(port: int) -> CountingSMTP:
+    server = CountingSMTP("127.0.0.1", port, timeout=5)
+    server.ehlo()
+    server.writes = 0
+    return server
+
+
+def test_prepare_data_dot_stuffs_and_terminates():
+    assert prepare_data(b".a\nb\r\n.c") == b"..a\r\nb\r\n..c\r\n.\r\n"
+
+
+def test_send_batch_pipelines_the_envelope(sink):
+    recipients = [f"rcpt{n}@example.org" for n in range(20)]
+    server = connect(sink.port)
+    assert server.has_extn("pipelining")
+
+    replies = send_batch(server, "sender@example.com", recipients, prepare_data(MESSAGE))
+    writes = server.writes
+    server.quit()
+
+    assert [code for code, _ in replies] == [250] * 20
+    # Envelope, DATA and the message body: three writes whatever the number of recipients
+    assert writes == 3
+    assert (sink.stats.transactions, sink.stats.recipients) == (1, 20)
+
+
+def test_send_batch_without_pipelining_sends_commands_one_by_one(sink):
+    recipients = [f"rcpt{n}@example.org" for n in range(5)]
+    server = connect(sink.port)
+    del server.esmtp_features["pipelining"]
+
+    replies = send_batch(server, "sender@example.com", recipients, prepare_data(MESSAGE))
+    writes = server.writes
+    server.quit()
+
+    assert [code for code, _ in replies] == [250] * 5
+    # MAIL, one RCPT per recipient, DATA and the message body
+    assert writes == 1 + 5 + 2
+    assert (sink.stats.transactions, sink.stats.recipients) == (1, 5)
+
+
+def test_send_batch_skips_data_when_every_recipient_is_refused(sink):
+    sink.error_rate = 1.0
+    server = connect(sink.port)
+
+    replies = send_batch(server, "sender@example.com", ["a@example.org", "b@example.org"], prepare_data(MESSAGE))
+    server.quit()
+
+    assert [code for code, _ in replies] == [451, 451]
+    assert sink.stats.transactions == 0
+
+
+def test_relay_groups_recipients_by_domain(sink):
+    contacts = [(n, {"email": f"rcpt{n}@domain{n % 3}.org"}) for n in range(120)]
+    results = {}
+    sender = BatchSender(account(sink.port), MESSAGE, mode="relay", size=2, batch_size=25)
+
+    sent, failed = sender.send_all(contacts, lambda index, contact, success, response: results.update({index: success}))
+
+    assert (sent, failed) == (120, 0)
+    assert results == {n: True for n in range(120)}
+    # 40 recipients per domain in batches of 25: two transactions per domain
+    assert sender.transactions == sink.stats.transactions == 6
+    assert sink.stats.recipients == 120
+
+
+def test_relay_retries_temporarily_refused_recipients(sink, monkeypatch):
+    monkeypatch.setattr(batch_delivery, "backoff_delay", lambda attempt: 0)
+    sink.error_rate = 0.3
+    sender = BatchSender(account(sink.port), MESSAGE, mode="relay", size=2, transient_retries=20)
+
+    sent, failed = sender.send_all([(n, {"email": f"rcpt{n}@example.org"}) for n in range(60)])
+
+    assert (sent, failed) == (60, 0)
+    assert sink.stats.recipients == 60
+
+
+def test_direct_mx_retries_a_failed_lookup(sink, monkeypatch):
+    lookups = []
+
+    def resolve_mx(domain):
+        lookups.append(domain)
+        if len(lookups) == 1:
+            raise smtplib.SMTPResponseException(451, b"4.4.3 MX lookup failed")
+        return [("127.0.0.1", sink.port)]
+
+    monkeypatch.setattr(batch_delivery, "resolve_mx", resolve_mx)
+    monkeypatch.setattr(batch_delivery, "backoff_delay", lambda attempt: 0)
+    monkeypatch.setattr(batch_delivery, "ALLOW_DIRECT_MX", True)
+    monkeypatch.setattr(batch_delivery, "DIRECT_MX_SENDER_DOMAINS", frozenset({"example.com"}))
+    sender = BatchSender(account(sink.port), MESSAGE, mode="mx", size=1)
+
+    sent, failed = sender.send_all([(n, {"email": f"rcpt{n}@example.org"}) for n in range(5)])
+
+    assert (sent, failed) == (5, 0)
+    assert len(lookups) == 2
+
+
+def test_direct_mx_is_off_unless_the_operator_allows_the_sender(monkeypatch):
+    monkeypatch.setattr(batch_delivery, "ALLOW_DIRECT_MX", False)
+    with pytest.raises(ValueError):
+        check_direct_mx_sender("sender@example.com")
+
+    monkeypatch.setattr(batch_delivery, "ALLOW_DIRECT_MX", True)
+    monkeypatch.setattr(batch_delivery, "DIRECT_MX_SENDER_DOMAINS", frozenset({"example.com"}))
+    check_direct_mx_sender("sender@example.com")
+    with pytest.raises(ValueError):
+        check_direct_mx_sender("ceo@bank.example")
+    with pytest.raises(ValueError):
+        BatchSender({"email_user": "ceo@bank.example"}, MESSAGE, mode="mx")
@@ -0,0 +1,14 @@
+"""
+Import Time tests - the cold-start budget and lazy imports checked by benchmarks/import_time.py
+"""
+
+import statistics
+
+from import_time import DEFAULT_BUDGET_MS, eager_modules, main_import_ms, measure
+
+
+def test_main_imports_within_budget_and_defers_heavy_modules():
+    runs = [measure() for _ in range(3)]
+
+    assert [eager_modules(modules) for modules in runs] == [[], [], []]
+    assert statistics.median(main_import_ms(modules) for modules in runs) <= DEFAULT_BUDGET_MS
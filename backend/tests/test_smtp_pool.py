@@ -0,0 +1,32 @@
+"""
+SMTP Pool tests - parked warm sessions against the local sink
+"""
+
+import time
+
+import smtp_pool
+from conftest import account
+
+
+def test_unclaimed_warm_connection_is_closed_after_its_ttl(sink, monkeypatch):
+    monkeypatch.setattr(smtp_pool, "WARM_CONNECTION_TTL", 0.2)
+    settings = account(sink.port)
+    smtp_pool.warm_connection(settings)
+    connection, _ = smtp_pool._warm_connections[smtp_pool._account_key(settings)]
+
+    time.sleep(0.5)
+
+    assert smtp_pool._account_key(settings) not in smtp_pool._warm_connections
+    assert connection.server is None
+
+
+def test_claimed_warm_connection_outlives_its_ttl(sink, monkeypatch):
+    monkeypatch.setattr(smtp_pool, "WARM_CONNECTION_TTL", 0.2)
+    settings = account(sink.port)
+    smtp_pool.warm_connection(settings)
+    connection = smtp_pool.claim_warm_connection(settings, 100)
+
+    time.sleep(0.5)
+
+    assert connection.server is not None
+    connection.close()
@@ -12,13 +12,13 @@ import { Badge } from "@/components/ui/badge"
 import { Button } from "@/components/ui/button"
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from "@/components/ui/table"
 import { Progress } from "@/components/ui/progress"
-import { apiService, DashboardStats, Campaign } from "@/lib/api"
+import { apiService, DashboardStats, RecentCampaign } from "@/lib/api"
 import { Mail, Users, FileText, Clock, CheckCircle, XCircle, AlertCircle, Settings } from "lucide-react"
 import { Alert, AlertDescription } from "@/components/ui/alert"
 
 export default function Dashboard() {
   const [stats, setStats] = useState<DashboardStats | null>(null)
-  const [campaigns, setCampaigns] = useState<Campaign[]>([])
+  const [campaigns, setCampaigns] = useState<RecentCampaign[]>([])
   const [loading, setLoading] = useState(true)
   const { user, isLoading } = useAuth()
   const router = useRouter()
@@ -39,12 +39,10 @@ export default function Dashboard() {
   const loadDashboardData = async () => {
     try {
       setLoading(true)
-      const [statsResponse, campaignsResponse] = await Promise.all([
-        apiService.getDashboardStats(),
-        apiService.getCampaigns()
-      ])
+      // Totals and recent campaigns arrive in a single request
+      const statsResponse = await apiService.getDashboardStats()
       setStats(statsResponse)
-      setCampaigns(campaignsResponse.campaigns)
+      setCampaigns(statsResponse.recent_campaigns)
     } catch (error) {
       console.error("Error loading dashboard data:", error)
     } finally {
@@ -11,6 +11,8 @@ import { apiService, Contact, EmailTemplate, CampaignStatus, FileAttachment } fr
 import { useToast } from "@/components/ui/use-toast"
 import { useAuth } from "@/components/auth-provider"
 
+const FINISHED_STATUSES = ['completed', 'completed_with_errors', 'failed']
+
 interface SendEmailModalProps {
   open: boolean
   onOpenChange: (open: boolean) => void
@@ -29,29 +31,53 @@ export function SendEmailModal({ open, onOpenChange, contacts, subject, body, at
   const { user } = useAuth()
 
   useEffect(() => {
-    if (campaignId && isSending) {
-      // Poll for status updates
-      const interval = setInterval(async () => {
+    // Warm the backend while the user reviews the email so the send request doesn't pay the cold start
+    if (open && user) {
+      apiService.warmup().catch((error) => console.warn('Warm-up request failed:', error))
+    }
+  }, [open, user])
+
+  useEffect(() => {
+    if (!campaignId || !isSending) return
+
+    let cancelled = false
+    let closeStream: (() => void) | null = null
+    let interval: NodeJS.Timeout | null = null
+
+    const handleStatus = (status: CampaignStatus) => {
+      setCampaignStatus(status)
+      if (FINISHED_STATUSES.includes(status.status)) {
+        setIsSending(false)
+      }
+    }
+
+    // Fallback when the event stream can't be used: poll the status route every 2 seconds
+    const startPolling = () => {
+      if (cancelled || interval) return
+      interval = setInterval(async () => {
         try {
-          const status = await apiService.getCampaignStatus(campaignId)
-          setCampaignStatus(status)
-          
-          if (status.status === 'completed' || status.status === 'failed') {
-            setIsSending(false)
-            clearInterval(interval)
-            setStatusInterval(null)
-          }
+          handleStatus(await apiService.getCampaignStatus(campaignId))
         } catch (error) {
           console.error('Error fetching campaign status:', error)
         }
-      }, 2000) // Poll every 2 seconds
-      
+      }, 2000)
       setStatusInterval(interval)
     }
 
+    // Progress is pushed by the server as it happens
+    apiService.streamCampaignStatus(campaignId, handleStatus, (error) => {
+      console.warn('Campaign status stream unavailable, polling instead:', error)
+      startPolling()
+    }).then((close) => {
+      if (cancelled) close()
+      else closeStream = close
+    }).catch(startPolling)
+
     return () => {
-      if (statusInterval) {
-        clearInterval(statusInterval)
+      cancelled = true
+      closeStream?.()
+      if (interval) {
+        clearInterval(interval)
       }
     }
   }, [campaignId, isSending])
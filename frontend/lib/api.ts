@@ -36,7 +36,7 @@ export interface DashboardStats {
   total_campaigns: number
   total_emails_sent: number
   total_emails_failed: number
-  recent_campaigns: any[]
+  recent_campaigns: RecentCampaign[]
   templates_count: number
   has_email_settings: boolean
 }
@@ -56,11 +56,18 @@ export interface Campaign {
   updated_at: string
 }
 
+export type RecentCampaign = Pick<
+  Campaign,
+  'id' | 'name' | 'subject' | 'status' | 'progress' | 'sent_count' | 'failed_count' | 'total_emails' | 'created_at'
+> & { tracker_id: string | null }
+
 export interface SendEmailRequest {
   contacts: Contact[]
   template: EmailTemplate
   user_id: string
   attachments?: FileAttachment[]
+  // Templates without placeholders can be sent to many recipients per SMTP transaction
+  delivery?: 'single' | 'relay' | 'mx'
 }
 
 export interface CampaignStatus {
@@ -80,11 +87,25 @@ export interface EmailSettings {
   email_user: string
   email_display_name: string
   is_active: boolean
+  weight: number
   created_at: string
   updated_at: string
 }
 
+export interface SendingAccount extends EmailSettings {
+  // null when the account has no daily limit
+  remaining_today: number | null
+}
+
 class ApiService {
+  private async getAccessToken(): Promise<string | null> {
+    if (typeof window === 'undefined') return null
+    const { createBrowserSupabaseClient } = await import('@/lib/supabase')
+    const supabase = createBrowserSupabaseClient()
+    const { data: { session } } = await supabase.auth.getSession()
+    return session?.access_token ?? null
+  }
+
   private async request<T>(
     endpoint: string,
     options: RequestInit = {}
@@ -102,14 +123,12 @@ class ApiService {
     // Add auth token if available
     if (typeof window !== 'undefined') {
       try {
-        const { createBrowserSupabaseClient } = await import('@/lib/supabase')
-        const supabase = createBrowserSupabaseClient()
-        const { data: { session } } = await supabase.auth.getSession()
+        const accessToken = await this.getAccessToken()
         
-        if (session?.access_token) {
+        if (accessToken) {
           config.headers = {
             ...config.headers,
-            'Authorization': `Bearer ${session.access_token}`,
+            'Authorization': `Bearer ${accessToken}`,
           }
         } else {
           console.warn('No session found - user might not be authenticated')
@@ -153,10 +172,56 @@ class ApiService {
     })
   }
 
+  // Pre-initializes the backend (Supabase client, SMTP session) ahead of a send; failures are harmless
+  async warmup(): Promise<{ warmed: boolean; accounts?: number }> {
+    return this.request('/api/warmup', {
+      method: 'POST',
+    })
+  }
+
   async getCampaignStatus(campaignId: string): Promise<CampaignStatus> {
     return this.request(`/api/campaigns/${campaignId}/status`)
   }
 
+  // Pushes status updates over Server-Sent Events until the campaign finishes.
+  // onError is called if the stream can't be opened or drops, so the caller can fall back to polling.
+  async streamCampaignStatus(
+    campaignId: string,
+    onStatus: (status: CampaignStatus) => void,
+    onError: (error: Event | Error) => void
+  ): Promise<() => void> {
+    if (typeof window === 'undefined' || typeof EventSource === 'undefined') {
+      onError(new Error('EventSource is not supported'))
+      return () => {}
+    }
+    // EventSource cannot send an Authorization header, so the token goes in the query string
+    const accessToken = await this.getAccessToken()
+    const url = `${API_BASE_URL}/api/campaigns/${campaignId}/events?access_token=${encodeURIComponent(accessToken ?? '')}`
+    const source = new EventSource(url)
+    let finished = false
+
+    source.addEventListener('status', (event) => {
+      onStatus({ campaign_id: campaignId, ...JSON.parse((event as MessageEvent).data) })
+    })
+    source.addEventListener('end', () => {
+      finished = true
+      source.close()
+    })
+    // The campaign is running on another server instance, which this stream cannot follow
+    source.addEventListener('poll', () => {
+      finished = true
+      source.close()
+      onError(new Error('Campaign is not tracked by this server'))
+    })
+    source.onerror = (event) => {
+      // CONNECTING means the browser is retrying on its own (e.g. the server closed a long stream)
+      if (finished || source.readyState === EventSource.CONNECTING) return
+      source.close()
+      onError(event)
+    }
+    return () => source.close()
+  }
+
   // Template management
   async getTemplates(): Promise<{ templates: SavedTemplate[] }> {
     return this.request('/api/templates')
@@ -196,12 +261,16 @@ class ApiService {
     return this.request('/api/email-settings')
   }
 
+  // Without id this saves the primary account; add_account creates an additional one
   async saveEmailSettings(settings: {
+    id?: string
+    add_account?: boolean
     email_host: string
     email_port: number
     email_user: string
     email_password: string
     email_display_name: string
+    weight?: number
   }): Promise<EmailSettings> {
     return this.request('/api/email-settings', {
       method: 'POST',
@@ -209,6 +278,16 @@ class ApiService {
     })
   }
 
+  async getSendingAccounts(): Promise<{ accounts: SendingAccount[] }> {
+    return this.request('/api/email-settings/accounts')
+  }
+
+  async removeSendingAccount(accountId: string): Promise<{ message: string }> {
+    return this.request(`/api/email-settings/${accountId}`, {
+      method: 'DELETE',
+    })
+  }
+
   async testEmailSettings(settings: {
     email_host: string
     email_port: number